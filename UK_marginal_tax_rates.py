@@ -3,6 +3,12 @@ import numpy as np
 import plotly.graph_objects as go
 from PIL import Image
 import json
+import os
+
+from UK_tax_cache import DiskResultCache, ResultCache, content_hash
+import UK_tax_library as library
+from UK_tax_engine import calculate_tax_components, combine_income_tax, compile_schedule
+from UK_tax_html import copy_alongside, write_figure_html, write_figures_html, write_interactive_html
 
 # if set to [] then charts everything, or can be e.g. ["rUK 2023-24", "rUK 2024-25"] 
 DATA_TO_CHART = []
@@ -19,14 +25,44 @@ STUDENT_LOAN_THRESHOLD = 27295 # this is plan two, started course between 1 Sept
 INCLUDE_CHILD_BENEFIT = True
 CHILDREN = 3
 
+# heatmap of marginal rate against income for each of these numbers of children (with child benefit, and childcare
+# subsidy if INCLUDE_CHILDCARE), all calculated in one pass
+PLOT_BY_NUMBER_OF_CHILDREN = False
+NUMBERS_OF_CHILDREN = range(0, 7)
+
 INCLUDE_CHILDCARE = False  # note if childcare subsidies are modelled it swamps all other marginal rate effects.
 INCLUDE_MARRIAGE_ALLOWANCE = False   # also swamps all other marginal rate effects
 PLOT_GROSS_VS_NET = True   # highly recommended if showing childcare subsidy or marriage allowance
 
+# if True, each line is drawn from just the points where its slope changes (from the exact calculation), with the
+# marginal rate as steps, rather than a point every RESOLUTION. Much smaller charts, and no sampling errors - but note
+# the childcare and marriage allowance cliffs then show as jumps in net income, not as spikes in the marginal rate
+BREAKPOINT_TRACES = False
+
 # Constants
 RESOLUTION = 100        # the amount by which gross salary is incremented
 MAX_INCOME = 180000  
 
+# how many calculated dataframes to keep, so each (dataset, child benefit, student loan) is only calculated once
+RESULT_CACHE_SIZE = 64
+
+# results are also saved here between runs, so only datasets that have changed are recalculated. None to turn off
+RESULT_CACHE_DIRECTORY = ".tax_cache"
+RESULT_CACHE_MAX_FILES = 256
+RESULT_CACHE_VERSION = 1   # increase if the calculation itself changes, so old results aren't reused
+
+# "show" opens each chart in the browser (each page embedding its own copy of plotly.js and the logo), "separate"
+# writes each chart to its own html file in HTML_DIRECTORY, and "combined" writes them all to one page,
+# COMBINED_HTML_FILE. Both of the latter load plotly.js from one shared file and link to the logo rather than
+# embedding it, so the directory can be published as is.
+# "interactive" writes INTERACTIVE_HTML_FILE instead, which holds just the compiled schedules and draws the charts in
+# the browser, with controls for children, student loan etc - so it stays small however many datasets are charted.
+# Nothing is calculated in Python in that mode, so EXPORT_TO_EXCEL has no effect
+CHART_OUTPUT = "show"
+HTML_DIRECTORY = "charts"
+COMBINED_HTML_FILE = "UK_marginal_tax_rates.html"
+INTERACTIVE_HTML_FILE = "UK_marginal_tax_rates_interactive.html"
+
 DATASET_FILENAME = "UK_marginal_tax_datasets.json"
 LOGO_FILE = "logo_full_white_on_blue.jpg"
 
@@ -39,11 +75,14 @@ def load_data_from_json():
             print("Tax rate data not found")
             exit()
             
-def load_logo():
-    
-    logo_jpg = Image.open(LOGO_FILE)
+def load_logo(linked=False):
+    # linked: refer to a copy of the logo next to the html files, rather than embedding it in every chart
+    if linked:
+        logo_source = copy_alongside(LOGO_FILE, HTML_DIRECTORY)
+    else:
+        logo_source = Image.open(LOGO_FILE)
     return [dict(
-            source=logo_jpg,
+            source=logo_source,
             xref="paper", yref="paper",
             x=1, y=1.01,
             sizex=0.1, sizey=0.1,
@@ -56,116 +95,142 @@ def export_to_excel(dataframes):
             df.to_excel(writer, sheet_name=name)
         
     print(f"Written to Excel {EXCEL_FILE}")
-    
-
-# Unified function to calculate tax and NI
-def calculate_tax_and_ni(gross_income, relevant_dataset, tax_type, do_child_benefit, do_student_loan):
-    
-    relevant_data = tax_data[relevant_dataset]
-    total_tax = 0
-    
-    # tweaks for income tax
-    if tax_type == "income tax":
-        
-        # deal with personal allowance taper and marriage allowance
-        if gross_income > relevant_data["allowance withdrawal threshold"]:
-            modified_personal_allowance = max(0, relevant_data["statutory personal allowance"] - relevant_data["allowance withdrawal rate"] * (gross_income - relevant_data["allowance withdrawal threshold"]))
-        
-        elif INCLUDE_MARRIAGE_ALLOWANCE and gross_income < relevant_data["marriage allowance max earnings"]:
-            modified_personal_allowance = relevant_data["statutory personal allowance"] * (1 + relevant_data["marriage allowance"])
-        else:
-            modified_personal_allowance = relevant_data["statutory personal allowance"]
-            
-        taxable_net_income = max(0, gross_income - modified_personal_allowance)
-        
-        # apply HICBC. Note we don't do this quite right, because the real HICBC calculation operates in steps of 200
-        # but a discontinuous function breaks plotly, so we use a continuous function instead. 
-        # this will mean slightly too much tax is paid before each step change (<1%), but shouldn't impact the marginal rate
-        if do_child_benefit and CHILDREN > 0:
-            total_child_benefit = 52 * (relevant_data["child benefit"]["1st"] + relevant_data["child benefit"]["subsequent"] * (CHILDREN - 1))
-            if gross_income < relevant_data["HICBC start"]:
-                HICBC = 0
-            elif gross_income > relevant_data["HICBC end"]:
-                HICBC = total_child_benefit
-            else:
-                hicbc_step = (relevant_data["HICBC end"] - relevant_data["HICBC start"]) / 100
-                number_of_steps = (gross_income - relevant_data["HICBC start"]) / hicbc_step
-
-                HICBC = total_child_benefit * number_of_steps / 100
-                
-        else:
-            HICBC = 0
-            
-        total_tax += HICBC
-            
-        
-        if relevant_dataset == "rUK 2024-25":
-            print(gross_income, HICBC, total_tax)
-            
-        # give childcare subsidy (modelled as a negative tax, not technically correct but gives right result)
-        if INCLUDE_CHILDCARE and CHILDREN > 0:
-            if relevant_data["childcare min earnings"] < gross_income < relevant_data["childcare max earnings"]:
-                total_tax -= relevant_data["childcare subsidy per child"] * min(CHILDREN, relevant_data["childcare max children"])
-                
-        # simple student loan modelling - modelled as income tax, not technically correct but economically it is a tax
-        if do_student_loan and gross_income > STUDENT_LOAN_THRESHOLD:
-            total_tax += (gross_income - STUDENT_LOAN_THRESHOLD) * STUDENT_LOAN_RATE
 
+def output_charts(figures):
+    # figures is a dict of {html filename: figure}, output as set by CHART_OUTPUT
+    if CHART_OUTPUT == "show":
+        for fig in figures.values():
+            fig.show()
+    elif CHART_OUTPUT == "separate":
+        for filename, fig in figures.items():
+            write_figure_html(fig, os.path.join(HTML_DIRECTORY, filename))
+        print(f"Written {len(figures)} charts to {HTML_DIRECTORY}")
+    elif CHART_OUTPUT == "combined":
+        write_figures_html(figures.values(), os.path.join(HTML_DIRECTORY, COMBINED_HTML_FILE), "UK marginal tax rates")
+        print(f"Written {len(figures)} charts to {os.path.join(HTML_DIRECTORY, COMBINED_HTML_FILE)}")
     else:
-        
-        taxable_net_income = gross_income
-            
-    
-    
-    last_threshold = 0
+        raise ValueError(f"CHART_OUTPUT should be 'show', 'separate', 'combined' or 'interactive', not '{CHART_OUTPUT}'")
+
+def write_interactive_chart(tax_data):
+    schedules = {dataset: get_schedule(dataset) for dataset in DATA_TO_CHART if "exclude from chart" not in tax_data[dataset]}
+    path = os.path.join(HTML_DIRECTORY, INTERACTIVE_HTML_FILE)
+    write_interactive_html(schedules, path, "UK marginal tax rates", DEFAULT_DATASET, tax_options(INCLUDE_CHILD_BENEFIT, INCLUDE_STUDENT_LOAN),
+                           MAX_INCOME, RESOLUTION, logo=LOGO_FILE)
+    print(f"Written interactive chart of {len(schedules)} datasets to {path}")
     
-    for band in relevant_data[tax_type]:
-        if "threshold" not in band:
-            band["threshold"] = 1e12   # easier if we artificially give the highest band a limit
-            
-        gross_income_in_band = min(taxable_net_income, band["threshold"]) - last_threshold
-        tax_in_band = gross_income_in_band * band["rate"]
-        total_tax += tax_in_band
-            
-        last_threshold = band["threshold"]
-        
-        if taxable_net_income <= band["threshold"]:
-            break
-            
-    return total_tax
+# compiled TaxSchedule for each dataset, built the first time it is needed
+tax_schedules = {}
 
-def calculate_tax(dataset, do_child_benefit, do_student_loan):
+def get_schedule(dataset):
+    if dataset not in tax_schedules:
+        tax_schedules[dataset] = compile_schedule(tax_data[dataset])
+    return tax_schedules[dataset]
 
-    # Create a range of gross incomes
+
+# the settings at the top of this file, as a frozen options object for UK_tax_library
+def tax_options(do_child_benefit, do_student_loan):
+    return library.TaxOptions(do_child_benefit=do_child_benefit,
+                              do_student_loan=do_student_loan,
+                              children=CHILDREN,
+                              include_childcare=INCLUDE_CHILDCARE,
+                              include_marriage_allowance=INCLUDE_MARRIAGE_ALLOWANCE,
+                              student_loan_threshold=STUDENT_LOAN_THRESHOLD,
+                              student_loan_rate=STUDENT_LOAN_RATE)
+
+# options for the engine, taken from the settings at the top of this file
+def engine_options(do_child_benefit, do_student_loan):
+    return tax_options(do_child_benefit, do_student_loan).as_kwargs()
+
+# if exact is set, then rather than a row every RESOLUTION the dataframe has a row only at each breakpoint (plus MAX_INCOME),
+# and the marginal rate is the exact rate on the next £ earned from that point
+def calculate_tax(dataset, do_child_benefit, do_student_loan, exact=False):
+    if exact:
+        return library.calculate_tax_exact(get_schedule(dataset), MAX_INCOME, tax_options(do_child_benefit, do_student_loan))
+    return library.calculate_tax(get_schedule(dataset), np.arange(0, MAX_INCOME + RESOLUTION, RESOLUTION), tax_options(do_child_benefit, do_student_loan))
+
+# every element of calculate_tax for each number of children at once: each column is shaped (len(numbers_of_children), incomes)
+def calculate_tax_by_number_of_children(dataset, numbers_of_children, do_student_loan):
     gross_incomes = np.arange(0, MAX_INCOME + RESOLUTION, RESOLUTION)
+    children = np.asarray(numbers_of_children)[:, np.newaxis]
+    options = {**engine_options(True, do_student_loan), "children": children}
 
-    # Calculate net income and marginal rate
-    data = []
-    for i in range(len(gross_incomes)):
-        gross_income = gross_incomes[i]
-        income_tax = calculate_tax_and_ni(gross_income, dataset, "income tax", do_child_benefit, do_student_loan)
-        employee_ni = calculate_tax_and_ni(gross_income, dataset, "NI", None, None)
-        total_tax_ni = income_tax + employee_ni
-        net_income = gross_income - total_tax_ni
-        marginal_rate = 0 if i == 0 else (total_tax_ni - data[i-1][3]) / RESOLUTION
-        data.append([gross_income, income_tax, employee_ni, total_tax_ni, net_income, marginal_rate])
+    components = calculate_tax_components(gross_incomes, get_schedule(dataset), **options)
+    shape = (len(children), len(gross_incomes))
+    income_tax = np.broadcast_to(combine_income_tax(components), shape)
+    employee_ni = np.broadcast_to(components["NI"], shape)
+    total_tax_ni = income_tax + employee_ni
+
+    marginal_rate = np.zeros(shape)
+    marginal_rate[:, 1:] = np.diff(total_tax_ni, axis=1) / RESOLUTION
+
+    return {"children": children[:, 0],
+            "gross income": gross_incomes,
+            "income tax": income_tax,
+            "employee NI": employee_ni,
+            "total tax/NI": total_tax_ni,
+            "net income": gross_incomes - total_tax_ni,
+            "marginal rate": marginal_rate}
+
+# x, y and line shape for a chart trace of column ("marginal rate", in %, or "net income") from the dataframe
+# calculated for the dataset and options - or, with BREAKPOINT_TRACES, from the breakpoints of the exact calculation
+def chart_trace(df, dataset, do_child_benefit, do_student_loan, column):
+    if BREAKPOINT_TRACES:
+        x, y = library.calculate_breakpoint_traces(get_schedule(dataset), MAX_INCOME, tax_options(do_child_benefit, do_student_loan))[column]
+        line_shape = "hv" if column == "marginal rate" else "linear"
+    else:
+        x, y, line_shape = df["gross income"], df[column], "linear"
+    return dict(x=x, y=y * 100 if column == "marginal rate" else y, line_shape=line_shape)
 
-    # Create DataFrame
-    return pd.DataFrame(data, columns=["gross income", "income tax", "employee NI", "total tax/NI", "net income", "marginal rate"])
+result_cache = ResultCache(maxsize=RESULT_CACHE_SIZE)
+disk_cache = DiskResultCache(RESULT_CACHE_DIRECTORY, max_entries=RESULT_CACHE_MAX_FILES) if RESULT_CACHE_DIRECTORY else None
+
+# calculate_tax, but returning the same dataframe if it's already been calculated for this dataset and settings,
+# in this run or (via the disk cache) a previous one. Callers must treat the dataframe as read-only
+def cached_calculate_tax(dataset, do_child_benefit, do_student_loan, exact=False):
+    settings = (do_child_benefit, do_student_loan, exact, CHILDREN, INCLUDE_CHILDCARE, INCLUDE_MARRIAGE_ALLOWANCE,
+                STUDENT_LOAN_THRESHOLD, STUDENT_LOAN_RATE, RESOLUTION, MAX_INCOME, RESULT_CACHE_VERSION)
+    key = content_hash(tax_data[dataset], *settings)
+
+    def load_or_calculate():
+        if disk_cache is None:
+            return calculate_tax(dataset, do_child_benefit, do_student_loan, exact)
+
+        # one group per dataset name and settings, so the only other entry in a group is for an older version of
+        # the dataset's json - which is stale, and removed when this is saved
+        group = content_hash(dataset, *settings)[:16]
+        columns = disk_cache.load(group, key)
+        if columns is not None:
+            return pd.DataFrame(columns)
+        df = calculate_tax(dataset, do_child_benefit, do_student_loan, exact)
+        disk_cache.save(group, key, {column: df[column].to_numpy() for column in df.columns})
+        return df
+
+    return result_cache.get_or_compute(key, load_or_calculate)
 
 
 if __name__ == '__main__':
 
     tax_data = load_data_from_json()
-    logo_layout = load_logo()
 
     # if we are charting all datasets then populate list
     if DATA_TO_CHART == []:
         DATA_TO_CHART = list(tax_data.keys())
 
+    if CHART_OUTPUT == "interactive":
+        # the browser does the calculations, so there's nothing to sample or draw here
+        write_interactive_chart(tax_data)
+        if EXPORT_TO_EXCEL:
+            print("Not exporting to Excel, as nothing is calculated here with CHART_OUTPUT = 'interactive'")
+        exit()
+
+    logo_layout = load_logo(linked=CHART_OUTPUT != "show")
+
     # this is where we save the dataframes for excel export
     created_data = {}
 
+    # and the charts, which are output at the end
+    figures = {}
+
     # Plot of Gross Income vs. Marginal Rate
     fig_marginal_rate = go.Figure()
 
@@ -175,19 +240,19 @@ if __name__ == '__main__':
             continue
 
         
-        df = calculate_tax(dataset, False, False)
+        df = cached_calculate_tax(dataset, False, False)
         created_data[f"{dataset}"] = df
-        fig_marginal_rate.add_trace(go.Scatter(x=df['gross income'], y=df['marginal rate']*100, mode='lines', name=dataset, visible=True if dataset == DEFAULT_DATASET else 'legendonly'))
+        fig_marginal_rate.add_trace(go.Scatter(**chart_trace(df, dataset, False, False, 'marginal rate'), mode='lines', name=dataset, visible=True if dataset == DEFAULT_DATASET else 'legendonly'))
         
         if INCLUDE_CHILD_BENEFIT:
-            df = calculate_tax(dataset, True, False)
+            df = cached_calculate_tax(dataset, True, False)
             created_data[f"{dataset} CB"] = df
-            fig_marginal_rate.add_trace(go.Scatter(x=df['gross income'], y=df['marginal rate']*100, mode='lines', name=dataset + " w/ child benefit", visible='legendonly'))
+            fig_marginal_rate.add_trace(go.Scatter(**chart_trace(df, dataset, True, False, 'marginal rate'), mode='lines', name=dataset + " w/ child benefit", visible='legendonly'))
             
         if INCLUDE_STUDENT_LOAN: 
-            df = calculate_tax(dataset, True, True)
+            df = cached_calculate_tax(dataset, True, True)
             created_data[f"{dataset} CB SL"] = df
-            fig_marginal_rate.add_trace(go.Scatter(x=df['gross income'], y=df['marginal rate']*100, mode='lines', name=dataset + " w/ child benefit and student loans", visible='legendonly'))
+            fig_marginal_rate.add_trace(go.Scatter(**chart_trace(df, dataset, True, True, 'marginal rate'), mode='lines', name=dataset + " w/ child benefit and student loans", visible='legendonly'))
 
 
     title = "Gross employment income vs marginal tax rate"   
@@ -214,7 +279,7 @@ if __name__ == '__main__':
     fig_marginal_rate.update_xaxes(tickprefix="£")
     fig_marginal_rate.update_yaxes(ticksuffix="%")
 
-    fig_marginal_rate.show()
+    figures["marginal_rate.html"] = fig_marginal_rate
 
 
     if PLOT_GROSS_VS_NET:
@@ -226,20 +291,20 @@ if __name__ == '__main__':
                 # these are hypothetical examples we don't want to include in chart, as clutters up legend
                 continue
             
-            df = calculate_tax(dataset, False, False)
+            df = cached_calculate_tax(dataset, False, False)
             created_data[f"{dataset} gross v net"] = df
             
-            fig_net_income.add_trace(go.Scatter(x=df['gross income'], y=df['net income'], mode='lines', name=dataset,  hovertemplate='£%{y:,.0f}', visible=True if dataset == DEFAULT_DATASET else 'legendonly'))
+            fig_net_income.add_trace(go.Scatter(**chart_trace(df, dataset, False, False, 'net income'), mode='lines', name=dataset,  hovertemplate='£%{y:,.0f}', visible=True if dataset == DEFAULT_DATASET else 'legendonly'))
             
             if INCLUDE_CHILD_BENEFIT:
-                df = calculate_tax(dataset, True, False)
+                df = cached_calculate_tax(dataset, True, False)
                 created_data[f"{dataset} gross v net"] = df
-                fig_net_income.add_trace(go.Scatter(x=df['gross income'], y=df['net income'], mode='lines', name=dataset + " w/ child benefit",  hovertemplate='£%{y:,.0f}', visible='legendonly'))
+                fig_net_income.add_trace(go.Scatter(**chart_trace(df, dataset, True, False, 'net income'), mode='lines', name=dataset + " w/ child benefit",  hovertemplate='£%{y:,.0f}', visible='legendonly'))
                 
             if INCLUDE_STUDENT_LOAN: 
-                df = calculate_tax(dataset, True, True)
+                df = cached_calculate_tax(dataset, True, True)
                 created_data[f"{dataset} gross v net"] = df
-                fig_net_income.add_trace(go.Scatter(x=df['gross income'], y=df['net income'], mode='lines', name=dataset + " w/ child benefit and student loans",  hovertemplate='£%{y:,.0f}', visible='legendonly'))
+                fig_net_income.add_trace(go.Scatter(**chart_trace(df, dataset, True, True, 'net income'), mode='lines', name=dataset + " w/ child benefit and student loans",  hovertemplate='£%{y:,.0f}', visible='legendonly'))
             
             title = 'Gross employment income vs net income'
             if INCLUDE_CHILDCARE:
@@ -261,8 +326,41 @@ if __name__ == '__main__':
         fig_net_income.update_xaxes(tickprefix="£")
         fig_net_income.update_yaxes(tickprefix="£")
         
-        fig_net_income.show()
-        
+        figures["net_income.html"] = fig_net_income
+
+    if PLOT_BY_NUMBER_OF_CHILDREN:
+        by_children = calculate_tax_by_number_of_children(DEFAULT_DATASET, NUMBERS_OF_CHILDREN, False)
+
+        # marriage allowance and childcare cliffs would otherwise set the colour scale
+        fig_children = go.Figure(go.Heatmap(x=by_children["gross income"], y=by_children["children"], z=by_children["marginal rate"]*100,
+                                            zmin=0, zmax=100, colorscale="Viridis", colorbar=dict(ticksuffix="%"),
+                                            hovertemplate='£%{x:,.0f}, %{y} children: %{z:.1f}%<extra></extra>'))
+
+        title = f"Marginal tax rate by number of children, {DEFAULT_DATASET}"
+        if INCLUDE_CHILDCARE:
+            title += ", inc childcare subsidy"
+
+        fig_children.update_layout(
+                        title=title,
+                        title_font=dict(size=32),
+                        xaxis_title='Gross employment income (£)',
+                        xaxis_title_font=dict(size=18),
+                        yaxis_title='Number of children',
+                        yaxis_title_font=dict(size=18),
+                        images=logo_layout
+                    )
+
+        fig_children.update_xaxes(tickprefix="£")
+        fig_children.update_yaxes(dtick=1)
+
+        figures["marginal_rate_by_children.html"] = fig_children
+
+    output_charts(figures)
+
+    print(f"Result cache: {result_cache.stats()}")
+    if disk_cache is not None:
+        print(f"Disk cache: {disk_cache.stats()}")
+
     if EXPORT_TO_EXCEL:
         export_to_excel(created_data)
         
\ No newline at end of file
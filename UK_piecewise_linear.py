@@ -0,0 +1,170 @@
+import numpy as np
+
+"""
+Piecewise-linear functions of one variable.
+
+Segment i starts at breakpoints[i], where the function is values[i], and rises at slopes[i] until the next
+breakpoint. Below the first breakpoint the first segment is simply extended. The value at a breakpoint is the
+value of the segment starting there, so a jump (e.g. the childcare subsidy cliff) is represented by the next
+segment starting at a different value from the one the previous segment reached.
+
+Everything in the tax system we model is piecewise linear in gross income, so each element of the calculation
+can be built as one of these and then added together. The sum has one merged list of breakpoints, and is
+evaluated for any number of incomes with a single searchsorted.
+"""
+
+
+def read_only_array(values):
+    array = np.array(values, dtype=float)
+    array.flags.writeable = False
+    return array
+
+
+class PiecewiseLinear:
+
+    def __init__(self, breakpoints, values, slopes):
+        self.breakpoints = read_only_array(breakpoints)
+        self.values = read_only_array(values)
+        self.slopes = read_only_array(slopes)
+        if not (len(self.breakpoints) == len(self.values) == len(self.slopes) > 0):
+            raise ValueError("Need the same number (at least one) of breakpoints, values and slopes")
+        if np.any(np.diff(self.breakpoints) <= 0):
+            raise ValueError("Breakpoints must be increasing")
+
+    @classmethod
+    def constant(cls, value, at=0.0):
+        return cls([at], [value], [0.0])
+
+    @classmethod
+    def identity(cls):
+        return cls([0.0], [0.0], [1.0])
+
+    @classmethod
+    def step(cls, breakpoints, values):
+        return cls(breakpoints, values, np.zeros(len(breakpoints)))
+
+    def __repr__(self):
+        return f"PiecewiseLinear({len(self.breakpoints)} segments from {self.breakpoints[0]:,.2f} to {self.breakpoints[-1]:,.2f})"
+
+    def _segment(self, x):
+        return np.maximum(np.searchsorted(self.breakpoints, x, side="right") - 1, 0)
+
+    def __call__(self, x):
+        segment = self._segment(x)
+        return self.values[segment] + self.slopes[segment] * (x - self.breakpoints[segment])
+
+    def slope_at(self, x):
+        # the slope of the segment x is in, so at a breakpoint the slope to its right
+        return self.slopes[self._segment(x)]
+
+    def segment_ends(self):
+        # the value each segment reaches just before the next breakpoint
+        return self.values[:-1] + self.slopes[:-1] * np.diff(self.breakpoints)
+
+    def _jump_sizes(self, tolerance=1e-9):
+        # jump at each breakpoint after the first, ignoring rounding errors
+        jump_sizes = self.values[1:] - self.segment_ends()
+        return np.where(np.abs(jump_sizes) > tolerance * np.maximum(1, np.abs(self.values[1:])), jump_sizes, 0.0)
+
+    def jumps(self):
+        # (breakpoint, size) of each discontinuity
+        jump_sizes = self._jump_sizes()
+        return self.breakpoints[1:][jump_sizes != 0], jump_sizes[jump_sizes != 0]
+
+    def is_non_decreasing(self):
+        return bool(np.all(self.slopes >= 0) and np.all(self._jump_sizes() >= 0))
+
+    def _slopes_between(self, breakpoints):
+        # slope of each segment of a finer set of breakpoints. Taken from the middle of the segment rather than
+        # its start, so a breakpoint a rounding error away from one of ours can't pick up the wrong slope
+        midpoints = np.append((breakpoints[:-1] + breakpoints[1:]) / 2, breakpoints[-1] + 1)
+        return self.slope_at(midpoints)
+
+    def on_breakpoints(self, breakpoints):
+        # the same function, re-expressed on a finer set of breakpoints
+        breakpoints = np.unique(np.append(breakpoints, self.breakpoints))
+        return PiecewiseLinear(breakpoints, self(breakpoints), self._slopes_between(breakpoints))
+
+    def simplify(self, tolerance=1e-9):
+        # drop breakpoints where the next segment just continues the previous one
+        if len(self.breakpoints) == 1:
+            return self
+        continued = (self.slopes[1:] == self.slopes[:-1]) & (self._jump_sizes(tolerance) == 0)
+        keep = np.concatenate(([True], ~continued))
+        return PiecewiseLinear(self.breakpoints[keep], self.values[keep], self.slopes[keep])
+
+    def restrict(self, start, end):
+        # only the segments covering start to end, with the first starting exactly at start
+        function = self.on_breakpoints([start])
+        keep = (function.breakpoints >= start) & (function.breakpoints < end)
+        return PiecewiseLinear(function.breakpoints[keep], function.values[keep], function.slopes[keep])
+
+    def __add__(self, other):
+        if not isinstance(other, PiecewiseLinear):
+            return PiecewiseLinear(self.breakpoints, self.values + other, self.slopes)
+        breakpoints = np.union1d(self.breakpoints, other.breakpoints)
+        return PiecewiseLinear(breakpoints, self(breakpoints) + other(breakpoints), self._slopes_between(breakpoints) + other._slopes_between(breakpoints)).simplify()
+
+    __radd__ = __add__
+
+    def __neg__(self):
+        return PiecewiseLinear(self.breakpoints, -self.values, -self.slopes)
+
+    def __sub__(self, other):
+        return self + (-other)
+
+    def __rsub__(self, other):
+        return (-self) + other
+
+    def __mul__(self, factor):
+        if isinstance(factor, PiecewiseLinear):
+            raise TypeError("The product of two piecewise-linear functions isn't piecewise linear")
+        return PiecewiseLinear(self.breakpoints, self.values * factor, self.slopes * factor)
+
+    __rmul__ = __mul__
+
+    def derivative(self):
+        # a step function; at a jump the derivative is taken to be the slope either side (see jumps())
+        return PiecewiseLinear.step(self.breakpoints, self.slopes).simplify()
+
+    def compose(self, inner):
+        # self(inner(x)), for a non-decreasing inner function. The breakpoints are inner's own plus wherever
+        # inner reaches one of our breakpoints
+        if not inner.is_non_decreasing():
+            raise ValueError("Can only compose with a non-decreasing function")
+
+        levels = self.breakpoints
+        segment = np.maximum(np.searchsorted(inner.values, levels, side="right") - 1, 0)
+        slopes = inner.slopes[segment]
+        rising = slopes > 0
+        crossings = inner.breakpoints[segment][rising] + (levels[rising] - inner.values[segment][rising]) / slopes[rising]
+
+        breakpoints = np.union1d(inner.breakpoints, crossings)
+        midpoints = np.append((breakpoints[:-1] + breakpoints[1:]) / 2, breakpoints[-1] + 1)
+        composed_slopes = self.slope_at(inner(midpoints)) * inner.slope_at(midpoints)
+        return PiecewiseLinear(breakpoints, self(inner(breakpoints)), composed_slopes).simplify()
+
+    def inverse(self):
+        # for a non-decreasing function. A flat segment becomes a jump in the inverse, and a jump becomes a flat segment
+        if not self.is_non_decreasing():
+            raise ValueError("Can only invert a non-decreasing function")
+
+        ends = np.append(self.segment_ends(), np.inf)
+        jump_sizes = np.append(self._jump_sizes(), 0.0)
+        breakpoints, values, slopes = [], [], []
+        for i in range(len(self.breakpoints)):
+            if self.slopes[i] > 0:
+                breakpoints.append(self.values[i])
+                values.append(self.breakpoints[i])
+                slopes.append(1 / self.slopes[i])
+            if jump_sizes[i] > 0:
+                breakpoints.append(ends[i])
+                values.append(self.breakpoints[i + 1])
+                slopes.append(0.0)
+        if not breakpoints:
+            raise ValueError("Can't invert a constant function")
+
+        # where several segments start at the same level, the last one applies
+        breakpoints, values, slopes = np.array(breakpoints), np.array(values), np.array(slopes)
+        last = np.append(breakpoints[1:] != breakpoints[:-1], True)
+        return PiecewiseLinear(breakpoints[last], values[last], slopes[last])
@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+"""
+Caching of calculated results, so that the same (dataset, options, income grid) is only ever computed once.
+
+Keys are built from a content hash of the dataset's json block rather than its name, so editing a dataset
+can never return a stale result for it.
+
+ResultCache keeps results in memory for one run; DiskResultCache keeps them in .npz files between runs.
+"""
+
+
+def content_hash(*parts):
+    # stable hash of json-serialisable parts (dicts are hashed with sorted keys, so key order doesn't matter)
+    serialised = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(serialised.encode("utf-8")).hexdigest()
+
+
+def write_atomically(path, write):
+    # calls write(f) with a binary file, writing to a temporary file that's then renamed to path, so another
+    # process never sees (or memory-maps) a partial file
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    handle, temporary_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(handle, "wb") as f:
+            write(f)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+
+class ResultCache:
+    # size-bounded LRU cache that counts its hits and misses. Safe to share between threads
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        # compute is called outside the lock, so a slow calculation doesn't hold up other threads
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return f"{self.hits} hits, {self.misses} misses ({100 * self.hit_rate():.0f}% hit rate), {len(self)}/{self.maxsize} entries"
+
+
+class DiskResultCache:
+    # keeps tables of numbers (dicts of equal-length arrays, e.g. a dataframe's columns) in .npz files between runs.
+    # Each entry belongs to a group: everything in its key except the dataset's json (e.g. the dataset's name and
+    # every setting). Saving a new entry for a group deletes the group's old entries, which can then only be for an
+    # edited dataset, so stale; and the least recently used entries beyond max_entries go too
+
+    def __init__(self, directory, max_entries=256):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, group, key):
+        return os.path.join(self.directory, f"{group}-{key}.npz")
+
+    def load(self, group, key):
+        path = self._path(group, key)
+        try:
+            with np.load(path, allow_pickle=False) as saved:
+                columns = {str(name): saved[f"column_{i}"] for i, name in enumerate(saved["columns"])}
+        except (OSError, ValueError, KeyError):
+            # missing, or half-written by a run that crashed - either way, recalculate
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)   # mark as recently used
+        except FileNotFoundError:
+            pass   # evicted by another process since it was read; the columns are still good
+        self.hits += 1
+        return columns
+
+    def save(self, group, key, columns):
+        path = self._path(group, key)
+        write_atomically(path, lambda f: np.savez(f, columns=np.array(list(columns)), **{f"column_{i}": np.asarray(values) for i, values in enumerate(columns.values())}))
+
+        for filename in os.listdir(self.directory):
+            if filename.startswith(f"{group}-") and filename.endswith(".npz") and filename != os.path.basename(path):
+                self._remove(filename)
+        self._evict_least_recently_used()
+
+    def _remove(self, filename):
+        try:
+            os.remove(os.path.join(self.directory, filename))
+        except FileNotFoundError:
+            pass   # another process got there first
+
+    def _last_used(self, filename):
+        try:
+            return os.path.getmtime(os.path.join(self.directory, filename))
+        except FileNotFoundError:
+            return 0.0   # already removed by another process, so removing it again is harmless
+
+    def _evict_least_recently_used(self):
+        entries = [filename for filename in os.listdir(self.directory) if filename.endswith(".npz")]
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=self._last_used)
+        for filename in entries[:len(entries) - self.max_entries]:
+            self._remove(filename)
+
+    def clear(self):
+        if os.path.isdir(self.directory):
+            for filename in os.listdir(self.directory):
+                if filename.endswith(".npz"):
+                    self._remove(filename)
+
+    def stats(self):
+        return f"{self.hits} hits, {self.misses} misses"
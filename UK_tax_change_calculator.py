@@ -1,5 +1,10 @@
 import pandas as pd
+import numpy as np
 import json
+from functools import lru_cache
+
+import UK_tax_library as library
+from UK_tax_engine import compile_schedule
 
 """
 Important notes and limitations
@@ -13,21 +18,26 @@ Important notes and limitations
 DATASET_INITIAL = "rUK 2024-25"
 DATASET_POLICY_CHANGE = "Reform UK manifesto"
 
-# this uses the ETIs recommended by the Scottish Fiscal Commission. The Scottish figures will be higher than for the rest of the UK
-# given the obvious propoensity for Scottish taxpayers to move to England... this therefore likely represents an over-estimate
-# https://www.fiscalcommission.scot/publications/how-we-forecast-behavioural-responses-to-income-tax-policy-march-2018/
-ELASTICITY_OF_TAXABLE_INCOME = {
-                                50000: 0.015,
-                                80000: 0.10,
-                                150000: 0.20,
-                                300000: 0.35,
-                                500000: 0.55,
-                                1e9: 0.75
-                                }
+# {income threshold: ETI}. By default the ETIs recommended by the Scottish Fiscal Commission (see UK_tax_library for the
+# source and caveats), but can be replaced with another table here
+ELASTICITY_OF_TAXABLE_INCOME = dict(library.DEFAULT_ELASTICITY_OF_TAXABLE_INCOME)
 
 # for testing how sensitive the analysis is to the ETI
 ETI_SENSITIVITY_FACTOR = 1.00
 
+# if True, the ETI changes smoothly with income rather than stepping at each threshold above (e.g. from 0.015 to 0.10
+# at £50,000), so perturbing an income across a threshold doesn't create an artificial jump in revenue. Each band's
+# ETI applies at the middle of its band (the top band's from its lower threshold) and is interpolated in between
+INTERPOLATE_ETI = False
+
+# the dynamic estimate is also recalculated with the ETIs scaled by each of these (all in one pass), and printed as a
+# sensitivity table. calculate_eti_sensitivity can also take whole alternative ELASTICITY_OF_TAXABLE_INCOME tables
+ETI_SENSITIVITY_FACTORS = [0, 0.5, 1.0, 1.5, 2.0]
+
+# if True, marginal rates are worked out exactly from each dataset's bands and personal allowance taper.
+# If False, they're estimated by increasing gross income by GROSS_INCOME_PERTUBATION
+EXACT_MARGINAL_RATES = True
+
 # how much we increase the gross income to calculate the marginal rate. Fails to catch weird effects like the marriage allowance, but that's of limited relevance
 GROSS_INCOME_PERTUBATION = 1000
 
@@ -40,8 +50,8 @@ PRE_TAX_INCOME_PERCENTILE_DATA = "pre_tax_income_percentiles.xlsx"
 # that implies income growth in each percentile of 1.16
 WAGE_GROWTH_SINCE_2020_21 = 1.16
 
-# number of taxpayers for 2025/26 from row 9 table 3.7 here https://obr.uk/efo/economic-and-fiscal-outlook-march-2024/
-POPULATION_OF_TAXPAYERS = 37800000
+# number of taxpayers for 2025/26 (see UK_tax_library for the source)
+POPULATION_OF_TAXPAYERS = library.DEFAULT_POPULATION_OF_TAXPAYERS
 
 
 DATASET_FILENAME = "UK_marginal_tax_datasets.json"
@@ -55,58 +65,37 @@ def load_data_from_json():
             print("Tax rate data not found")
             exit()
             
+# the costing settings above, as a frozen options object for UK_tax_library
+def costing_options():
+    return library.CostingOptions(elasticity_table=ELASTICITY_OF_TAXABLE_INCOME,
+                                  eti_sensitivity_factor=ETI_SENSITIVITY_FACTOR,
+                                  interpolate_eti=INTERPOLATE_ETI,
+                                  exact_marginal_rates=EXACT_MARGINAL_RATES,
+                                  gross_income_perturbation=GROSS_INCOME_PERTUBATION,
+                                  population_of_taxpayers=POPULATION_OF_TAXPAYERS)
+
 def find_elasticity_for_income_level(gross_income):
-    for income_threshold in sorted(ELASTICITY_OF_TAXABLE_INCOME.keys()):
-        if gross_income <= income_threshold:
-            return ETI_SENSITIVITY_FACTOR * ELASTICITY_OF_TAXABLE_INCOME[income_threshold]
-    # Fallback in case all thresholds are lower than gross_income
-    return ETI_SENSITIVITY_FACTOR * ELASTICITY_OF_TAXABLE_INCOME[max(ELASTICITY_OF_TAXABLE_INCOME.keys())]
-
-# Unified function to calculate tax and NI
-def calculate_tax_and_ni(gross_income, relevant_dataset, tax_type):
-    
-    relevant_data = tax_data[relevant_dataset]
-    total_tax = 0
-    
-    # tweaks for income tax
-    if tax_type == "income tax":
-        
-        
-        # deal with personal allowance taper and marriage allowance
-        if gross_income > relevant_data["allowance withdrawal threshold"]:
-            modified_personal_allowance = max(0, relevant_data["statutory personal allowance"] - relevant_data["allowance withdrawal rate"] * (gross_income - relevant_data["allowance withdrawal threshold"]))
-        
-        else:
-            modified_personal_allowance = relevant_data["statutory personal allowance"]
-            
-        taxable_net_income = max(0, gross_income - modified_personal_allowance)
+    return float(find_elasticity_for_income_levels(gross_income))
 
-    else:
-        
-        taxable_net_income = gross_income
-                
-    last_threshold = 0
-    
-    for band in relevant_data[tax_type]:
-        if "threshold" not in band:
-            band["threshold"] = 1e12   # easier if we artificially give the highest band a limit
-            
-        gross_income_in_band = min(taxable_net_income, band["threshold"]) - last_threshold
-        tax_in_band = gross_income_in_band * band["rate"]
-        total_tax += tax_in_band
-            
-        last_threshold = band["threshold"]
-        
-        if taxable_net_income <= band["threshold"]:
-            break
-            
-    return total_tax
+# Array version of find_elasticity_for_income_level. Can be given a different table, sensitivity factor or interpolation setting
+def find_elasticity_for_income_levels(gross_incomes, elasticity_table=None, sensitivity_factor=None, interpolate=None):
+    changes = {}
+    if elasticity_table is not None:
+        changes["elasticity_table"] = tuple(elasticity_table.items())
+    if sensitivity_factor is not None:
+        changes["eti_sensitivity_factor"] = sensitivity_factor
+    if interpolate is not None:
+        changes["interpolate_eti"] = interpolate
+    return library.find_elasticities(gross_incomes, library.with_costing_changes(costing_options(), **changes))
+
+# compiled TaxSchedule for each dataset, built the first time it is needed
+tax_schedules = {}
 
+def get_schedule(dataset):
+    if dataset not in tax_schedules:
+        tax_schedules[dataset] = compile_schedule(tax_data[dataset])
+    return tax_schedules[dataset]
 
-def return_total_tax(gross_income, dataset):
-    income_tax = calculate_tax_and_ni(gross_income, dataset, "income tax")
-    ni = calculate_tax_and_ni(gross_income, dataset, "NI")
-    return income_tax + ni
 
 def friendly_number(n):
     suffixes = {1: 'st', 2: 'nd', 3: 'rd'}
@@ -116,6 +105,17 @@ def friendly_number(n):
         suffix = suffixes.get(n % 10, 'th')
     return f"{n}{suffix}"
 
+# percentile number and gross income (uprated by WAGE_GROWTH_SINCE_2020_21) for each percentile point.
+# Only read from the spreadsheet once
+@lru_cache(maxsize=1)
+def load_percentile_incomes():
+    df = pd.read_excel(PRE_TAX_INCOME_PERCENTILE_DATA)
+    percentiles = df.iloc[:, 0].to_numpy()
+    gross_incomes = df.iloc[:, 1].to_numpy(dtype=float) * WAGE_GROWTH_SINCE_2020_21
+    percentiles.flags.writeable = False
+    gross_incomes.flags.writeable = False
+    return percentiles, gross_incomes
+
 """
 methodology here:
 1. work out current tax position of taxpayer and marginal rate
@@ -124,66 +124,74 @@ methodology here:
 4. calculate final tax position in light of increased taxable income
 """  
 
+# steps 1 to 4 of the methodology for every gross income at once, returning a dict of numpy columns
+# elasticity can be given as an array, shaped (incomes,) or (ETI variants, incomes), instead of being looked up
+def calculate_effect_of_change_arrays(gross_incomes, schedule_initial, schedule_policy_change, baseline=None, elasticity=None):
+    return library.calculate_effect_of_change(gross_incomes, schedule_initial, schedule_policy_change, costing_options(), baseline, elasticity)
+
+# each percentile point stands for 1% of taxpayers; returns £bn. Sums over the last axis, so for a
+# (scenario x percentile) array gives the change for each scenario
+def total_revenue_change(tax_change):
+    return library.total_revenue_change(tax_change, costing_options())
+
+# presentation step: the results table, formatted for printing
+def format_effect_of_change(percentiles, results):
+    return pd.DataFrame({
+        'Percentile': [friendly_number(percentile) for percentile in percentiles],
+        'Gross Income': [f"£{x:,.0f}" for x in results["gross income"]],
+        'Current Tax': [f"£{x:,.0f}" for x in results["current tax"]],
+        'Marginal Rate': [f"{100 * x:.1f}%" for x in results["marginal rate"]],
+        'New tax (static)': [f"£{x:,.0f}" for x in results["new tax (static)"]],
+        'New marginal rate': [f"{100 * x:,.1f}%" for x in results["new marginal rate"]],
+        'Delta marginal rate': [f"{100 * x:,.1f}%" for x in results["new marginal rate"] - results["marginal rate"]],
+        'Dynamic gross income': [f"£{x:,.0f}" for x in results["dynamic gross income"]],
+        'New tax (Dynamic)': [f"£{x:,.0f}" for x in results["new tax (dynamic)"]],
+        'DYNAMIC TAX CHANGE': [f"£{x:,.0f}" for x in results["dynamic tax change"]],
+    })
+
+# static and dynamic estimates (£bn) under each of several ETI scenarios, calculated in one pass. Each scenario is
+# either a factor to scale ELASTICITY_OF_TAXABLE_INCOME by, or a whole alternative table in the same form.
+# The table is relative to the central estimate (the ETIs as set above), and sorted by how far from it each
+# scenario is, so can be drawn as a tornado chart
+def calculate_eti_sensitivity(gross_incomes, schedule_initial, schedule_policy_change, eti_scenarios):
+    gross_incomes = np.asarray(gross_incomes, dtype=float)
+
+    labels = ["central"]
+    elasticities = [find_elasticity_for_income_levels(gross_incomes)]
+    for scenario in eti_scenarios:
+        if isinstance(scenario, dict):
+            labels.append("alternative ETI table " + ", ".join(f"{threshold:,.0f}: {elasticity}" for threshold, elasticity in sorted(scenario.items())))
+            elasticities.append(find_elasticity_for_income_levels(gross_incomes, elasticity_table=scenario, sensitivity_factor=1))
+        else:
+            labels.append(f"ETI x {scenario}")
+            elasticities.append(find_elasticity_for_income_levels(gross_incomes, sensitivity_factor=scenario))
+
+    results = calculate_effect_of_change_arrays(gross_incomes, schedule_initial, schedule_policy_change, elasticity=np.array(elasticities))
+    static_change = total_revenue_change(results["static tax change"])
+    dynamic_change = total_revenue_change(results["dynamic tax change"])
+
+    sensitivity_table = pd.DataFrame({
+        "ETI scenario": labels,
+        "Static estimate (£bn)": static_change,
+        "Dynamic estimate (£bn)": dynamic_change,
+        "Behavioural effect (£bn)": dynamic_change - static_change,
+        "Change from central (£bn)": dynamic_change - dynamic_change[0],
+    })
+    sensitivity_table = sensitivity_table.iloc[1:]
+    return sensitivity_table.reindex(sensitivity_table["Change from central (£bn)"].abs().sort_values(ascending=False).index).reset_index(drop=True)
+
 def calculate_effect_of_change():
 
-    # Create a range of gross incomes
     # Load the percentiles
-    df = pd.read_excel(PRE_TAX_INCOME_PERCENTILE_DATA)
+    percentiles, gross_incomes = load_percentile_incomes()
 
-    data = []    
-    total_static_tax_after_policy_change = 0
-    total_dynamic_tax_after_policy_change = 0
-
-    # Iterate through the percentiles and calculate tax for each row
-    for index, row in df.iterrows():
-        percentile = row.iloc[0]
-        gross_income = row.iloc[1] * WAGE_GROWTH_SINCE_2020_21
-        
-        total_tax_initial = return_total_tax(gross_income, DATASET_INITIAL)
-        total_tax_initial_plus_pertubation = return_total_tax(gross_income + GROSS_INCOME_PERTUBATION, DATASET_INITIAL)
-        marginal_rate_initial = (total_tax_initial_plus_pertubation - total_tax_initial) / GROSS_INCOME_PERTUBATION
-        retention_rate_initial = 1 - marginal_rate_initial
-        
-        total_tax_after_policy_change = return_total_tax(gross_income, DATASET_POLICY_CHANGE)
-        total_tax_after_policy_change_plus_pertubation = return_total_tax(gross_income + GROSS_INCOME_PERTUBATION, DATASET_POLICY_CHANGE)
-        marginal_rate_after_policy_change = (total_tax_after_policy_change_plus_pertubation - total_tax_after_policy_change) / GROSS_INCOME_PERTUBATION
-        retention_rate_after_policy_change = 1 - marginal_rate_after_policy_change
-        
-        percentage_change_in_marginal_retention_rate = (retention_rate_after_policy_change - retention_rate_initial) / retention_rate_initial
-        percentage_change_in_taxable_income = percentage_change_in_marginal_retention_rate * find_elasticity_for_income_level(gross_income)
-        
-        dynamic_gross_income = gross_income * (1 + percentage_change_in_taxable_income)
-        dynamic_tax_after_policy_change = return_total_tax(dynamic_gross_income, DATASET_POLICY_CHANGE)
-        
-        
-        dynamic_tax_change = dynamic_tax_after_policy_change - total_tax_initial
-        total_static_tax_after_policy_change += (total_tax_after_policy_change - total_tax_initial) * POPULATION_OF_TAXPAYERS / 100 / 1e9
-        total_dynamic_tax_after_policy_change += dynamic_tax_change * POPULATION_OF_TAXPAYERS / 100 / 1e9
-        
-        # net_income = gross_income - total_tax_ni
-        row = {
-            'Percentile': friendly_number(percentile),
-            'Gross Income': f"£{gross_income:,.0f}",
-            'Current Tax': f"£{total_tax_initial:,.0f}",
-            'Marginal Rate': f"{100 * marginal_rate_initial:.1f}%",
-            'New tax (static)': f"£{total_tax_after_policy_change:,.0f}",
-            'New marginal rate': f"{100*marginal_rate_after_policy_change:,.1f}%",
-            'Delta marginal rate': f"{100*(marginal_rate_after_policy_change - marginal_rate_initial):,.1f}%",
-            'Dynamic gross income': f"£{dynamic_gross_income:,.0f}",
-            'New tax (Dynamic)': f"£{dynamic_tax_after_policy_change:,.0f}",
-            'DYNAMIC TAX CHANGE': f"£{dynamic_tax_change:,.0f}"
-        }
-        data.append(row)
-    
-        # print(f"{friendly_number(percentile)}: gross income £{gross_income:,.0f}, current tax £{total_tax_initial:,.0f} and marginal rate {100*marginal_rate_initial:.1f}% to £{total_tax_after_policy_change:,.0f} - marginal rate reduction {100 * percentage_reduction_in_marginal_rate:.1f}. Dynamic effects increase income {percentage_increase_in_taxable_income} and dynamic tax {dynamic_tax_after_policy_change:,.0f}")
-        
-        
-        
-    results_dataframe = pd.DataFrame(data)
-    # results_dataframe.set_option('display.max_rows', len(df))
+    results = calculate_effect_of_change_arrays(gross_incomes, get_schedule(DATASET_INITIAL), get_schedule(DATASET_POLICY_CHANGE))
 
+    total_static_tax_after_policy_change = total_revenue_change(results["static tax change"])
+    total_dynamic_tax_after_policy_change = total_revenue_change(results["dynamic tax change"])
+
+    results_dataframe = format_effect_of_change(percentiles, results)
     print(results_dataframe.to_string(index=False))
-        
 
     return total_static_tax_after_policy_change, total_dynamic_tax_after_policy_change
 
@@ -196,4 +204,10 @@ if __name__ == '__main__':
     print(f"\nCalculated impact of '{DATASET_POLICY_CHANGE}' compared to '{DATASET_INITIAL}':")
     print(f"Static estimate: £{static_change:,.0f}bn")
     print(f"Dynamic estimate: £{dynamic_change:,.0f}bn")
+
+    if ETI_SENSITIVITY_FACTORS:
+        _, gross_incomes = load_percentile_incomes()
+        sensitivity_table = calculate_eti_sensitivity(gross_incomes, get_schedule(DATASET_INITIAL), get_schedule(DATASET_POLICY_CHANGE), ETI_SENSITIVITY_FACTORS)
+        print("\nSensitivity of the dynamic estimate to the ETI:")
+        print(sensitivity_table.to_string(index=False, float_format=lambda x: f"{x:,.1f}"))
     
@@ -0,0 +1,221 @@
+import itertools
+import json
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from UK_tax_engine import calculate_marginal_rates, calculate_tax_components, combine_total_tax, compile_schedule, total_tax_function
+from UK_tax_library import TaxOptions, load_datasets
+
+"""
+Self-check that the ways of calculating tax agree.
+
+reference_total_tax is the original scalar calculation from UK_marginal_tax_rates (one gross income at a time,
+reading the json dataset directly), with its settings passed in as a TaxOptions rather than read from globals. It
+is kept here, and only here, as the reference the array engine in UK_tax_engine is checked against.
+
+The exact calculations are checked against the engine too: total_tax_function (used for the exact exports and
+breakpoint charts) must give the same total tax, and calculate_marginal_rates (used for costing) the same slope, at
+every income on the grid and at every breakpoint - where rounding is most likely to put an income on the wrong side.
+
+The browser's port of the engine, UK_tax_html.TAX_EVALUATOR_JS, is checked the same way if node is installed.
+
+Run this file after changing the engine, the evaluator or the datasets: it compares them for every dataset and
+every combination of options across a grid of gross incomes, and exits with an error if any differ.
+"""
+
+# gross incomes checked: every £97 (so the grid doesn't line up with round-number thresholds) up to this
+CHECK_MAX_INCOME = 300000
+CHECK_RESOLUTION = 97
+
+CHECK_CHILDREN = (0, 1, 3)
+
+# the largest difference in total tax (£) that counts as agreeing
+CHECK_TOLERANCE = 1e-6
+
+# and in a marginal rate
+CHECK_RATE_TOLERANCE = 1e-9
+
+
+def reference_tax_and_ni(gross_income, relevant_data, tax_type, options):
+    total_tax = 0
+
+    # tweaks for income tax
+    if tax_type == "income tax":
+
+        # deal with personal allowance taper and marriage allowance
+        if gross_income > relevant_data["allowance withdrawal threshold"]:
+            modified_personal_allowance = max(0, relevant_data["statutory personal allowance"] - relevant_data["allowance withdrawal rate"] * (gross_income - relevant_data["allowance withdrawal threshold"]))
+
+        elif options.include_marriage_allowance and gross_income < relevant_data["marriage allowance max earnings"]:
+            modified_personal_allowance = relevant_data["statutory personal allowance"] * (1 + relevant_data["marriage allowance"])
+        else:
+            modified_personal_allowance = relevant_data["statutory personal allowance"]
+
+        taxable_net_income = max(0, gross_income - modified_personal_allowance)
+
+        # apply HICBC. Note we don't do this quite right, because the real HICBC calculation operates in steps of 200
+        # but a discontinuous function breaks plotly, so we use a continuous function instead.
+        # this will mean slightly too much tax is paid before each step change (<1%), but shouldn't impact the marginal rate
+        if options.do_child_benefit and options.children > 0:
+            total_child_benefit = 52 * (relevant_data["child benefit"]["1st"] + relevant_data["child benefit"]["subsequent"] * (options.children - 1))
+            if gross_income < relevant_data["HICBC start"]:
+                HICBC = 0
+            elif gross_income > relevant_data["HICBC end"]:
+                HICBC = total_child_benefit
+            else:
+                hicbc_step = (relevant_data["HICBC end"] - relevant_data["HICBC start"]) / 100
+                number_of_steps = (gross_income - relevant_data["HICBC start"]) / hicbc_step
+
+                HICBC = total_child_benefit * number_of_steps / 100
+
+        else:
+            HICBC = 0
+
+        total_tax += HICBC
+
+        # give childcare subsidy (modelled as a negative tax, not technically correct but gives right result)
+        if options.include_childcare and options.children > 0:
+            if relevant_data["childcare min earnings"] < gross_income < relevant_data["childcare max earnings"]:
+                total_tax -= relevant_data["childcare subsidy per child"] * min(options.children, relevant_data["childcare max children"])
+
+        # simple student loan modelling - modelled as income tax, not technically correct but economically it is a tax
+        if options.do_student_loan and gross_income > options.student_loan_threshold:
+            total_tax += (gross_income - options.student_loan_threshold) * options.student_loan_rate
+
+    else:
+
+        taxable_net_income = gross_income
+
+    last_threshold = 0
+
+    for band in relevant_data[tax_type]:
+        threshold = band.get("threshold", 1e12)   # easier if we artificially give the highest band a limit
+
+        gross_income_in_band = min(taxable_net_income, threshold) - last_threshold
+        tax_in_band = gross_income_in_band * band["rate"]
+        total_tax += tax_in_band
+
+        last_threshold = threshold
+
+        if taxable_net_income <= threshold:
+            break
+
+    return total_tax
+
+
+def reference_total_tax(gross_income, relevant_data, options=TaxOptions()):
+    return reference_tax_and_ni(gross_income, relevant_data, "income tax", options) + reference_tax_and_ni(gross_income, relevant_data, "NI", options)
+
+
+def check_options():
+    # every combination of the options, for CHECK_CHILDREN
+    for do_child_benefit, do_student_loan, children, include_childcare, include_marriage_allowance in itertools.product(
+            (False, True), (False, True), CHECK_CHILDREN, (False, True), (False, True)):
+        yield TaxOptions(do_child_benefit=do_child_benefit, do_student_loan=do_student_loan, children=children,
+                         include_childcare=include_childcare, include_marriage_allowance=include_marriage_allowance)
+
+
+def check_engine(tax_data, gross_incomes):
+    # largest difference between the engine and reference_total_tax, and where it was
+    worst = (0.0, None, None, None)
+    for dataset, relevant_data in tax_data.items():
+        schedule = compile_schedule(relevant_data)
+        for options in check_options():
+            engine = combine_total_tax(calculate_tax_components(gross_incomes, schedule, **options.as_kwargs()))
+            reference = np.array([reference_total_tax(gross_income, relevant_data, options) for gross_income in gross_incomes.tolist()])
+            differences = np.abs(engine - reference)
+            i = int(np.argmax(differences))
+            if differences[i] > worst[0]:
+                worst = (float(differences[i]), dataset, options, float(gross_incomes[i]))
+    return worst
+
+
+def check_exact(tax_data, gross_incomes):
+    # largest differences between total_tax_function and the engine's total tax, and between the function's slope
+    # and calculate_marginal_rates; at gross_incomes plus each breakpoint of the function below the highest of them
+    worst_tax = [0.0, None, None, None]
+    worst_rate = [0.0, None, None, None]
+    for dataset, relevant_data in tax_data.items():
+        schedule = compile_schedule(relevant_data)
+        for options in check_options():
+            total_tax = total_tax_function(schedule, **options.as_kwargs())
+            breakpoints = total_tax.breakpoints[(total_tax.breakpoints >= 0) & (total_tax.breakpoints <= gross_incomes[-1])]
+            incomes = np.union1d(gross_incomes, breakpoints)
+
+            tax_differences = np.abs(total_tax(incomes) - combine_total_tax(calculate_tax_components(incomes, schedule, **options.as_kwargs())))
+            rate_differences = np.abs(total_tax.slope_at(incomes) - calculate_marginal_rates(incomes, schedule, **options.as_kwargs()))
+            for differences, worst in ((tax_differences, worst_tax), (rate_differences, worst_rate)):
+                i = int(np.argmax(differences))
+                if differences[i] > worst[0]:
+                    worst[:] = (float(differences[i]), dataset, options, float(incomes[i]))
+    return worst_tax, worst_rate
+
+
+def check_javascript(tax_data, gross_incomes):
+    # as check_engine, but for TAX_EVALUATOR_JS run in node. None if node isn't installed
+    node = shutil.which("node")
+    if node is None:
+        return None
+    from UK_tax_html import TAX_EVALUATOR_JS, schedule_as_json
+
+    schedules = {dataset: compile_schedule(relevant_data) for dataset, relevant_data in tax_data.items()}
+    options_list = list(check_options())
+    cases = {"schedules": {dataset: schedule_as_json(schedule) for dataset, schedule in schedules.items()},
+             "options": [options.as_kwargs() for options in options_list],
+             "gross_incomes": gross_incomes.tolist()}
+    script = TAX_EVALUATOR_JS + """
+const cases = JSON.parse(require("fs").readFileSync(0, "utf8"));
+const results = {};
+for (const [dataset, schedule] of Object.entries(cases.schedules)) {
+    results[dataset] = cases.options.map(o => cases.gross_incomes.map(g => totalTax(schedule, g, o)));
+}
+process.stdout.write(JSON.stringify(results));
+"""
+    completed = subprocess.run([node, "-e", script], input=json.dumps(cases), capture_output=True, text=True, check=True)
+    results = json.loads(completed.stdout)
+
+    worst = (0.0, None, None, None)
+    for dataset, schedule in schedules.items():
+        for options, javascript in zip(options_list, results[dataset]):
+            engine = combine_total_tax(calculate_tax_components(gross_incomes, schedule, **options.as_kwargs()))
+            differences = np.abs(engine - np.array(javascript))
+            i = int(np.argmax(differences))
+            if differences[i] > worst[0]:
+                worst = (float(differences[i]), dataset, options, float(gross_incomes[i]))
+    return worst
+
+
+def report(name, worst, tolerance=CHECK_TOLERANCE, unit="£"):
+    difference, dataset, options, gross_income = worst
+    if difference <= tolerance:
+        print(f"{name}: agrees (largest difference {unit}{difference:.2g})")
+        return True
+    print(f"{name}: differs by {unit}{difference:,.6f} for '{dataset}' at £{gross_income:,.2f} with {options}")
+    return False
+
+
+if __name__ == '__main__':
+
+    tax_data = load_datasets()
+    gross_incomes = np.arange(0, CHECK_MAX_INCOME + 1, CHECK_RESOLUTION, dtype=float)
+    print(f"Checking {len(tax_data)} datasets, {len(list(check_options()))} combinations of options, {len(gross_incomes)} gross incomes")
+
+    start_time = time.perf_counter()
+    agrees = report("UK_tax_engine v reference", check_engine(tax_data, gross_incomes))
+
+    worst_tax, worst_rate = check_exact(tax_data, gross_incomes)
+    agrees = report("total_tax_function v UK_tax_engine", worst_tax) and agrees
+    agrees = report("calculate_marginal_rates v total_tax_function slope", worst_rate, CHECK_RATE_TOLERANCE, unit="") and agrees
+
+    javascript_worst = check_javascript(tax_data, gross_incomes)
+    if javascript_worst is None:
+        print("TAX_EVALUATOR_JS v UK_tax_engine: not checked, as node isn't installed")
+    else:
+        agrees = report("TAX_EVALUATOR_JS v UK_tax_engine", javascript_worst) and agrees
+    print(f"({time.perf_counter() - start_time:.1f}s)")
+
+    sys.exit(0 if agrees else 1)
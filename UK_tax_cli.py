@@ -0,0 +1,196 @@
+import argparse
+import json
+import sys
+
+"""
+Command line entry point.
+
+    python UK_tax_cli.py calc "rUK 2024-25" 62000 [more incomes...] [--child-benefit --children 2 --student-loan ...]
+    python UK_tax_cli.py chart [marginal | household]
+    python UK_tax_cli.py cost [--initial "rUK 2024-25"] [--policy "Reform UK manifesto"] [--eti-factor 1.5] [--table]
+    python UK_tax_cli.py export [datasets...] --output UK_marginal_tax_rates.xlsx [--exact]
+    python UK_tax_cli.py sweep "Reform UK manifesto" --vary "income tax[0].threshold=37700:62700:2500" --vary "income tax[1].rate=0.38,0.40,0.42"
+
+Only numpy is imported up front. pandas, plotly and PIL are imported by the commands that need them, so calc
+starts in tens of milliseconds rather than paying for the charting libraries on every one-off query.
+"""
+
+TAX_OPTION_ARGUMENTS = {
+    "child_benefit": "do_child_benefit",
+    "student_loan": "do_student_loan",
+    "children": "children",
+    "childcare": "include_childcare",
+    "marriage_allowance": "include_marriage_allowance",
+}
+
+
+def add_tax_option_arguments(parser):
+    parser.add_argument("--child-benefit", action="store_true", help="include the HICBC")
+    parser.add_argument("--children", type=int, default=0)
+    parser.add_argument("--student-loan", action="store_true", help="include plan two student loan repayments")
+    parser.add_argument("--childcare", action="store_true", help="include the childcare subsidy")
+    parser.add_argument("--marriage-allowance", action="store_true")
+
+
+def tax_options_from_arguments(args):
+    from UK_tax_library import TaxOptions
+    return TaxOptions(**{option: getattr(args, argument) for argument, option in TAX_OPTION_ARGUMENTS.items()})
+
+
+def load_dataset(args, dataset):
+    from UK_tax_library import load_datasets
+    tax_data = load_datasets(args.datasets)
+    if dataset not in tax_data:
+        sys.exit(f"Unknown dataset '{dataset}'. Datasets are: {', '.join(tax_data)}")
+    return tax_data[dataset]
+
+
+def command_calc(args):
+    import numpy as np
+    from UK_tax_library import calculate_breakdown
+
+    gross_incomes = np.array(args.gross_incomes, dtype=float)
+    results = calculate_breakdown(load_dataset(args, args.dataset), gross_incomes, tax_options_from_arguments(args))
+
+    if args.json:
+        print(json.dumps([dict(zip(results, row)) for row in zip(*(np.broadcast_to(values, gross_incomes.shape).tolist() for values in results.values()))]))
+        return
+    for i in range(len(gross_incomes)):
+        print(f"Gross £{gross_incomes[i]:,.2f}: income tax £{results['income tax'][i]:,.2f}, NI £{results['employee NI'][i]:,.2f}, "
+              f"net £{results['net income'][i]:,.2f}, marginal rate {100 * results['marginal rate'][i]:.1f}%")
+
+
+def command_chart(args):
+    import runpy
+    runpy.run_module({"marginal": "UK_marginal_tax_rates", "household": "UK_tax_household"}[args.chart], run_name="__main__")
+
+
+def command_cost(args):
+    import UK_tax_change_calculator as calculator
+    import UK_tax_library as library
+    from UK_tax_engine import compile_schedule
+
+    costing = library.with_costing_changes(calculator.costing_options(), eti_sensitivity_factor=args.eti_factor, interpolate_eti=args.interpolate_eti)
+    schedule_initial = compile_schedule(load_dataset(args, args.initial))
+    schedule_policy_change = compile_schedule(load_dataset(args, args.policy))
+
+    percentiles, gross_incomes = calculator.load_percentile_incomes()
+    results = library.calculate_effect_of_change(gross_incomes, schedule_initial, schedule_policy_change, costing)
+    if args.table:
+        print(calculator.format_effect_of_change(percentiles, results).to_string(index=False))
+    print(f"Calculated impact of '{args.policy}' compared to '{args.initial}':")
+    print(f"Static estimate: £{library.total_revenue_change(results['static tax change'], costing):,.1f}bn")
+    print(f"Dynamic estimate: £{library.total_revenue_change(results['dynamic tax change'], costing):,.1f}bn")
+
+
+def command_export(args):
+    import numpy as np
+    import pandas as pd
+    import UK_marginal_tax_rates as marginal_tax_rates
+    import UK_tax_library as library
+
+    tax_data = library.load_datasets(args.datasets)
+    datasets = args.dataset or list(tax_data)
+    options = tax_options_from_arguments(args)
+    max_income = args.max_income or marginal_tax_rates.MAX_INCOME
+    resolution = args.resolution or marginal_tax_rates.RESOLUTION
+
+    dataframes = {}
+    for dataset in datasets:
+        relevant_data = load_dataset(args, dataset)
+        if args.exact:
+            dataframes[dataset] = library.calculate_tax_exact(relevant_data, max_income, options)
+        else:
+            dataframes[dataset] = library.calculate_tax(relevant_data, np.arange(0, max_income + resolution, resolution), options)
+
+    if args.output.endswith(".csv"):
+        pd.concat(dataframes, names=["dataset", "row"]).reset_index(level="row", drop=True).to_csv(args.output)
+    else:
+        with pd.ExcelWriter(args.output) as writer:
+            for dataset, df in dataframes.items():
+                # Excel sheet names are at most 31 characters
+                df.to_excel(writer, sheet_name=dataset[:31])
+    print(f"Written {len(dataframes)} datasets to {args.output}")
+
+
+def parse_values(text):
+    # "37700:62700:2500" (start:stop:step, inclusive of stop) or "0.38,0.40,0.42"
+    import numpy as np
+    if ":" in text:
+        start, stop, step = (float(part) for part in text.split(":"))
+        return np.arange(start, stop + step / 2, step).tolist()
+    return [float(part) for part in text.split(",")]
+
+
+def command_sweep(args):
+    import UK_tax_sweep as tax_sweep
+    from UK_tax_engine import compile_schedule
+
+    parameter_ranges = {}
+    for vary in args.vary:
+        parameter, separator, values = vary.partition("=")
+        if not separator:
+            sys.exit(f"--vary should be PARAMETER=VALUES, not '{vary}'")
+        parameter_ranges[parameter.strip()] = parse_values(values)
+
+    try:
+        sweep = tax_sweep.build_sweep(load_dataset(args, args.dataset), parameter_ranges)
+    except ValueError as e:
+        sys.exit(str(e))
+    revenue = tax_sweep.sweep_revenue(sweep, compile_schedule(load_dataset(args, args.initial)))
+
+    print(f"Variants of '{args.dataset}' compared to '{args.initial}':")
+    for i in range(len(sweep)):
+        scenario = ", ".join(f"{parameter} = {value:,.2f}" for parameter, value in sweep.scenario(i).items())
+        print(f"{scenario}: static £{revenue['static'][i]:,.1f}bn, dynamic £{revenue['dynamic'][i]:,.1f}bn")
+
+
+def build_parser():
+    # the defaults for cost and sweep are UK_tax_change_calculator's DATASET_INITIAL and DATASET_POLICY_CHANGE,
+    # but are written out here so that building the parser doesn't import it (and pandas)
+    parser = argparse.ArgumentParser(description="UK marginal tax rate calculations")
+    parser.add_argument("--datasets", default="UK_marginal_tax_datasets.json", help="json file of datasets")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    calc = subparsers.add_parser("calc", help="tax, net income and marginal rate at one or more gross incomes")
+    calc.add_argument("dataset")
+    calc.add_argument("gross_incomes", type=float, nargs="+", metavar="gross_income")
+    calc.add_argument("--json", action="store_true", help="print the results as json")
+    add_tax_option_arguments(calc)
+    calc.set_defaults(handler=command_calc)
+
+    chart = subparsers.add_parser("chart", help="draw the interactive charts")
+    chart.add_argument("chart", nargs="?", choices=["marginal", "household"], default="marginal")
+    chart.set_defaults(handler=command_chart)
+
+    cost = subparsers.add_parser("cost", help="static and dynamic revenue effect of a policy change")
+    cost.add_argument("--initial", default="rUK 2024-25")
+    cost.add_argument("--policy", default="Reform UK manifesto")
+    cost.add_argument("--eti-factor", type=float, default=1.0, help="scale the ETIs by this")
+    cost.add_argument("--interpolate-eti", action="store_true")
+    cost.add_argument("--table", action="store_true", help="also print the percentile table")
+    cost.set_defaults(handler=command_cost)
+
+    export = subparsers.add_parser("export", help="write gross income, tax, net income and marginal rate tables to Excel or CSV")
+    export.add_argument("dataset", nargs="*", help="datasets to export (default all)")
+    export.add_argument("--output", default="UK_marginal_tax_rates.xlsx", help=".xlsx (a sheet per dataset) or .csv")
+    export.add_argument("--exact", action="store_true", help="a row at each breakpoint rather than every --resolution")
+    export.add_argument("--max-income", type=float)
+    export.add_argument("--resolution", type=float)
+    add_tax_option_arguments(export)
+    export.set_defaults(handler=command_export)
+
+    sweep = subparsers.add_parser("sweep", help="revenue effect of every combination of parameter values")
+    sweep.add_argument("dataset")
+    sweep.add_argument("--vary", action="append", required=True, metavar="PARAMETER=VALUES",
+                       help='e.g. "income tax[0].threshold=37700:62700:2500" or "income tax[1].rate=0.38,0.40,0.42"')
+    sweep.add_argument("--initial", default="rUK 2024-25")
+    sweep.set_defaults(handler=command_sweep)
+
+    return parser
+
+
+if __name__ == '__main__':
+
+    args = build_parser().parse_args()
+    args.handler(args)
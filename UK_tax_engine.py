@@ -0,0 +1,386 @@
+from dataclasses import dataclass, field, fields
+from functools import lru_cache
+from types import MappingProxyType
+
+import numpy as np
+
+from UK_piecewise_linear import PiecewiseLinear, read_only_array
+
+"""
+Array engine for the UK tax calculations.
+
+This does the same job as the original scalar calculation (kept as reference_total_tax in UK_tax_check, which
+checks the two agree), but takes a whole vector of gross incomes at once and returns each element of the calculation
+as its own array. The per-income Python loop is replaced by whole-array numpy operations, so a sweep at £1 resolution
+up to several million pounds costs a few numpy operations rather than millions of function calls.
+
+Each dataset from UK_marginal_tax_datasets.json is first compiled into a TaxSchedule. That never touches
+the json dicts again, and holds each set of bands as sorted thresholds plus the cumulative tax due at each
+threshold, so the tax on any income is one searchsorted and one multiply-add.
+
+Several schedules (e.g. variants of one policy) can be stacked into one with stack_schedules. The same functions
+then work on a (scenario x income) grid in one pass: pass incomes shaped (1, incomes) or (scenarios, incomes)
+and every result comes back shaped (scenarios, incomes).
+
+The number of children can be an array in the same way: children shaped (counts, 1) gives every result shaped
+(counts, incomes), so households with 0, 1, 2... children are all evaluated together.
+"""
+
+# plan two student loan, as in UK_marginal_tax_rates
+STUDENT_LOAN_RATE = 0.09
+STUDENT_LOAN_THRESHOLD = 27295
+
+
+@dataclass(frozen=True)
+class BandTable:
+    # lower_thresholds[i] is where band i starts; cumulative_tax[i] is the tax due on income up to that point
+    lower_thresholds: tuple
+    rates: tuple
+    cumulative_tax: tuple
+    _arrays: tuple = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "_arrays", tuple(read_only_array(values) for values in (self.lower_thresholds, self.rates, self.cumulative_tax)))
+
+    @classmethod
+    def from_bands(cls, bands):
+        lower_thresholds = [0.0]
+        rates = []
+        cumulative_tax = [0.0]
+        for i, band in enumerate(bands):
+            rates.append(float(band["rate"]))
+            if "threshold" not in band:
+                if i != len(bands) - 1:
+                    raise ValueError(f"Only the top band can be missing a threshold ('{band.get('name')}' is not the top band)")
+                break
+            threshold = float(band["threshold"])
+            if threshold <= lower_thresholds[-1]:
+                raise ValueError(f"Band thresholds must be increasing ('{band.get('name')}' starts at £{threshold:,.0f})")
+            cumulative_tax.append(cumulative_tax[-1] + (threshold - lower_thresholds[-1]) * band["rate"])
+            lower_thresholds.append(threshold)
+        else:
+            # every band has a threshold, so income above the last one is not taxed by these bands
+            rates.append(0.0)
+        return cls(tuple(lower_thresholds), tuple(rates), tuple(cumulative_tax))
+
+    def tax(self, income):
+        lower_thresholds, rates, cumulative_tax = self._arrays
+        band = np.maximum(np.searchsorted(lower_thresholds, income, side="right") - 1, 0)
+        return cumulative_tax[band] + rates[band] * (income - lower_thresholds[band])
+
+    def rate_at(self, income):
+        # the rate applying to the next £ of income, i.e. at a threshold this is the rate of the band above it
+        lower_thresholds, rates, _ = self._arrays
+        band = np.maximum(np.searchsorted(lower_thresholds, income, side="right") - 1, 0)
+        return rates[band]
+
+    def as_piecewise_linear(self):
+        return PiecewiseLinear(self.lower_thresholds, self.cumulative_tax, self.rates)
+
+
+@dataclass(frozen=True)
+class TaxSchedule:
+    income_tax: BandTable
+    NI: BandTable
+
+    statutory_personal_allowance: float
+    allowance_withdrawal_threshold: float
+    allowance_withdrawal_rate: float
+
+    child_benefit_first: float
+    child_benefit_subsequent: float
+    HICBC_start: float
+    HICBC_end: float
+
+    childcare_subsidy_per_child: float
+    childcare_min_earnings: float
+    childcare_max_earnings: float
+    childcare_max_children: int
+
+    marriage_allowance: float
+    marriage_allowance_max_earnings: float
+
+
+def compile_schedule(relevant_data):
+    # reads the json dict once; nothing in the dict is modified
+    return TaxSchedule(
+        income_tax=BandTable.from_bands(relevant_data["income tax"]),
+        NI=BandTable.from_bands(relevant_data["NI"]),
+        statutory_personal_allowance=relevant_data["statutory personal allowance"],
+        allowance_withdrawal_threshold=relevant_data["allowance withdrawal threshold"],
+        allowance_withdrawal_rate=relevant_data["allowance withdrawal rate"],
+        child_benefit_first=relevant_data["child benefit"]["1st"],
+        child_benefit_subsequent=relevant_data["child benefit"]["subsequent"],
+        HICBC_start=relevant_data["HICBC start"],
+        HICBC_end=relevant_data["HICBC end"],
+        childcare_subsidy_per_child=relevant_data["childcare subsidy per child"],
+        childcare_min_earnings=relevant_data["childcare min earnings"],
+        childcare_max_earnings=relevant_data["childcare max earnings"],
+        childcare_max_children=relevant_data["childcare max children"],
+        marriage_allowance=relevant_data["marriage allowance"],
+        marriage_allowance_max_earnings=relevant_data["marriage allowance max earnings"],
+    )
+
+
+class StackedBandTable:
+    # several BandTables evaluated side by side: row i of the result uses band table i. Uses the
+    # tax = sum over bands of (change in rate at the band) x (income above the band's lower threshold) form,
+    # which broadcasts; tables with fewer bands are padded with bands that never start. The sum is added up one band
+    # at a time, so memory use is a couple of (scenarios, incomes) arrays however many bands there are
+
+    def __init__(self, band_tables):
+        number_of_bands = max(len(band_table.lower_thresholds) for band_table in band_tables)
+        lower_thresholds = np.full((number_of_bands, len(band_tables), 1), np.inf)
+        rate_changes = np.zeros((number_of_bands, len(band_tables), 1))
+        for i, band_table in enumerate(band_tables):
+            lower_thresholds[:len(band_table.lower_thresholds), i, 0] = band_table.lower_thresholds
+            rate_changes[:len(band_table.rates), i, 0] = np.diff(band_table.rates, prepend=0.0)
+        self.lower_thresholds = lower_thresholds
+        self.rate_changes = rate_changes
+
+    def _result_shape(self, income):
+        return np.broadcast_shapes(np.shape(income), self.lower_thresholds.shape[1:])
+
+    def tax(self, income):
+        income = np.asarray(income, dtype=float)
+        tax = np.zeros(self._result_shape(income))
+        income_above = np.empty_like(tax)
+        for lower_threshold, rate_change in zip(self.lower_thresholds, self.rate_changes):
+            np.subtract(income, lower_threshold, out=income_above)
+            np.maximum(income_above, 0, out=income_above)
+            income_above *= rate_change
+            tax += income_above
+        return tax
+
+    def rate_at(self, income):
+        income = np.asarray(income, dtype=float)
+        rate = np.zeros(self._result_shape(income))
+        for lower_threshold, rate_change in zip(self.lower_thresholds, self.rate_changes):
+            rate += np.where(income >= lower_threshold, rate_change, 0.0)
+        return rate
+
+
+# when evaluating a stacked schedule (or any other 2D grid, e.g. a household's two incomes), evaluate at most this
+# many cells at once, to limit memory use
+MAX_CELLS_PER_PASS = 20000000
+
+
+def stack_schedules(schedules):
+    # one TaxSchedule whose fields are (scenarios, 1) columns, for evaluating every schedule at once.
+    # Unlike a compiled schedule, the result is not hashable, so can't be used with tax_functions
+    columns = {}
+    for schedule_field in fields(TaxSchedule):
+        if schedule_field.name in ("income_tax", "NI"):
+            columns[schedule_field.name] = StackedBandTable([getattr(schedule, schedule_field.name) for schedule in schedules])
+        else:
+            columns[schedule_field.name] = np.array([[getattr(schedule, schedule_field.name)] for schedule in schedules], dtype=float)
+    return TaxSchedule(**columns)
+
+
+def calculate_personal_allowance(gross_incomes, schedule, include_marriage_allowance):
+    statutory_allowance = schedule.statutory_personal_allowance
+    taper_applies = gross_incomes > schedule.allowance_withdrawal_threshold
+
+    tapered_allowance = np.maximum(0, statutory_allowance - schedule.allowance_withdrawal_rate * (gross_incomes - schedule.allowance_withdrawal_threshold))
+    personal_allowance = np.where(taper_applies, tapered_allowance, statutory_allowance)
+
+    if include_marriage_allowance:
+        marriage_allowance_applies = ~taper_applies & (gross_incomes < schedule.marriage_allowance_max_earnings)
+        personal_allowance = np.where(marriage_allowance_applies, statutory_allowance * (1 + schedule.marriage_allowance), personal_allowance)
+
+    return personal_allowance
+
+
+def calculate_total_child_benefit(schedule, children):
+    # annual child benefit; children can be an array
+    children = np.asarray(children)
+    return np.where(children > 0, 52 * (schedule.child_benefit_first + schedule.child_benefit_subsequent * (children - 1)), 0.0)
+
+
+def calculate_hicbc(gross_incomes, schedule, children):
+    # continuous version of the HICBC, as in the reference calculation in UK_tax_check (the real charge moves in steps of 1%)
+    total_child_benefit = calculate_total_child_benefit(schedule, children)
+    hicbc_step = (schedule.HICBC_end - schedule.HICBC_start) / 100
+    number_of_steps = (gross_incomes - schedule.HICBC_start) / hicbc_step
+
+    hicbc = np.where(gross_incomes < schedule.HICBC_start, 0, total_child_benefit * number_of_steps / 100)
+    return np.where(gross_incomes > schedule.HICBC_end, total_child_benefit, hicbc)
+
+
+def calculate_childcare_subsidy(gross_incomes, schedule, children):
+    # returned as a positive amount; callers subtract it from tax
+    eligible = (schedule.childcare_min_earnings < gross_incomes) & (gross_incomes < schedule.childcare_max_earnings)
+    subsidy = schedule.childcare_subsidy_per_child * np.minimum(children, schedule.childcare_max_children)
+    return np.where(eligible, subsidy, 0.0)
+
+
+def calculate_tax_components(gross_incomes, schedule, do_child_benefit=False, do_student_loan=False,
+                             children=0, include_childcare=False, include_marriage_allowance=False,
+                             student_loan_threshold=STUDENT_LOAN_THRESHOLD, student_loan_rate=STUDENT_LOAN_RATE):
+
+    gross_incomes = np.asarray(gross_incomes, dtype=float)
+    zeros = np.zeros_like(gross_incomes)
+
+    personal_allowance = calculate_personal_allowance(gross_incomes, schedule, include_marriage_allowance)
+    taxable_net_income = np.maximum(0, gross_incomes - personal_allowance)
+
+    if do_child_benefit and np.any(np.asarray(children) > 0):
+        hicbc = calculate_hicbc(gross_incomes, schedule, children)
+    else:
+        hicbc = zeros
+
+    if include_childcare and np.any(np.asarray(children) > 0):
+        childcare = calculate_childcare_subsidy(gross_incomes, schedule, children)
+    else:
+        childcare = zeros
+
+    if do_student_loan:
+        student_loan = np.maximum(0, gross_incomes - student_loan_threshold) * student_loan_rate
+    else:
+        student_loan = zeros
+
+    return {
+        "income tax": schedule.income_tax.tax(taxable_net_income),
+        "NI": schedule.NI.tax(gross_incomes),
+        "HICBC": hicbc,
+        "student loan": student_loan,
+        "childcare": childcare,
+    }
+
+
+def combine_income_tax(components):
+    # the reference calculation folds HICBC, student loan and the childcare subsidy into "income tax"; this does the same
+    return components["income tax"] + components["HICBC"] + components["student loan"] - components["childcare"]
+
+
+def combine_total_tax(components):
+    return combine_income_tax(components) + components["NI"]
+
+
+"""
+Exact marginal rates.
+
+Every element of the calculation is piecewise linear in gross income, so rather than sampling it we can build
+each element as a PiecewiseLinear function of gross income and add them together. The total has exactly the
+breakpoints where the slope of total tax changes (or tax jumps), and its slope in between is the exact marginal
+rate. The marginal rate at an income is the rate on the next £ earned, so at a breakpoint it is the rate of the
+segment that starts there.
+"""
+
+# max(0, x), for taxable income
+POSITIVE_PART = PiecewiseLinear([-1.0, 0.0], [0.0, 0.0], [0.0, 1.0])
+
+
+def personal_allowance_function(schedule, include_marriage_allowance):
+    statutory_allowance = schedule.statutory_personal_allowance
+    withdrawal_threshold = schedule.allowance_withdrawal_threshold
+    withdrawal_rate = schedule.allowance_withdrawal_rate
+
+    if withdrawal_rate > 0:
+        allowance = PiecewiseLinear([0.0, withdrawal_threshold, withdrawal_threshold + statutory_allowance / withdrawal_rate],
+                                    [statutory_allowance, statutory_allowance, 0.0],
+                                    [0.0, -withdrawal_rate, 0.0])
+    else:
+        allowance = PiecewiseLinear.constant(statutory_allowance)
+
+    if include_marriage_allowance:
+        # the extra allowance stops at the marriage allowance earnings limit, and never applies in the taper
+        marriage_allowance_end = min(schedule.marriage_allowance_max_earnings, np.nextafter(withdrawal_threshold, np.inf))
+        allowance = allowance + PiecewiseLinear.step([0.0, marriage_allowance_end], [statutory_allowance * schedule.marriage_allowance, 0.0])
+
+    return allowance
+
+
+@lru_cache(maxsize=256)
+def tax_functions(schedule, do_child_benefit=False, do_student_loan=False,
+                  children=0, include_childcare=False, include_marriage_allowance=False,
+                  student_loan_threshold=STUDENT_LOAN_THRESHOLD, student_loan_rate=STUDENT_LOAN_RATE):
+
+    # the same components as calculate_tax_components, each as a PiecewiseLinear function of gross income.
+    # Cached, as a schedule and its options are all hashable - so the result is a read-only view of the dict, which
+    # every caller shares
+    no_tax = PiecewiseLinear.constant(0.0)
+
+    taxable_income = POSITIVE_PART.compose(PiecewiseLinear.identity() - personal_allowance_function(schedule, include_marriage_allowance))
+
+    if do_child_benefit and children > 0:
+        total_child_benefit = float(calculate_total_child_benefit(schedule, children))
+        hicbc = PiecewiseLinear([0.0, schedule.HICBC_start, schedule.HICBC_end],
+                                [0.0, 0.0, total_child_benefit],
+                                [0.0, total_child_benefit / (schedule.HICBC_end - schedule.HICBC_start), 0.0])
+    else:
+        hicbc = no_tax
+
+    if include_childcare and children > 0:
+        # the subsidy needs earnings strictly above the minimum, so it starts just after it
+        subsidy = schedule.childcare_subsidy_per_child * min(children, schedule.childcare_max_children)
+        childcare = PiecewiseLinear.step([0.0, np.nextafter(schedule.childcare_min_earnings, np.inf), schedule.childcare_max_earnings], [0.0, subsidy, 0.0])
+    else:
+        childcare = no_tax
+
+    if do_student_loan:
+        student_loan = PiecewiseLinear([0.0, student_loan_threshold], [0.0, 0.0], [0.0, student_loan_rate])
+    else:
+        student_loan = no_tax
+
+    return MappingProxyType({
+        "income tax": schedule.income_tax.as_piecewise_linear().compose(taxable_income),
+        "NI": schedule.NI.as_piecewise_linear(),
+        "HICBC": hicbc,
+        "student loan": student_loan,
+        "childcare": childcare,
+    })
+
+
+def total_tax_function(schedule, **options):
+    return combine_total_tax(tax_functions(schedule, **options))
+
+
+def net_income_function(schedule, **options):
+    return PiecewiseLinear.identity() - total_tax_function(schedule, **options)
+
+
+# £. The allowance is worked out in floating point (e.g. 12570 * 1.1 with the marriage allowance is 13827.000000000002),
+# so taxable income that should be exactly at a band threshold can come out a fraction of a penny below it. When
+# deciding which band the next £ falls in, taxable income within this of a threshold counts as at it
+BAND_ROUNDING_TOLERANCE = 1e-6
+
+
+def calculate_marginal_rates(gross_incomes, schedule, do_child_benefit=False, do_student_loan=False,
+                             children=0, include_childcare=False, include_marriage_allowance=False,
+                             student_loan_threshold=STUDENT_LOAN_THRESHOLD, student_loan_rate=STUDENT_LOAN_RATE):
+
+    # the slope of total_tax_function at each income, worked out directly rather than by building the function,
+    # so that it also works for stacked schedules
+    gross_incomes = np.asarray(gross_incomes, dtype=float)
+
+    # each £ earned in the taper also removes allowance_withdrawal_rate of allowance, until there's none left
+    statutory_allowance = schedule.statutory_personal_allowance
+    in_taper = (gross_incomes >= schedule.allowance_withdrawal_threshold) & (statutory_allowance - schedule.allowance_withdrawal_rate * (gross_incomes - schedule.allowance_withdrawal_threshold) > BAND_ROUNDING_TOLERANCE)
+    untapered_taxable_income = gross_incomes - calculate_personal_allowance(gross_incomes, schedule, include_marriage_allowance)
+    taxable_income_slope = np.where(untapered_taxable_income >= -BAND_ROUNDING_TOLERANCE, 1 + np.where(in_taper, schedule.allowance_withdrawal_rate, 0), 0)
+
+    marginal_rate = schedule.income_tax.rate_at(np.maximum(0, untapered_taxable_income) + BAND_ROUNDING_TOLERANCE) * taxable_income_slope + schedule.NI.rate_at(gross_incomes)
+
+    if do_child_benefit and np.any(np.asarray(children) > 0):
+        total_child_benefit = calculate_total_child_benefit(schedule, children)
+        in_hicbc = (gross_incomes >= schedule.HICBC_start) & (gross_incomes < schedule.HICBC_end)
+        marginal_rate = marginal_rate + np.where(in_hicbc, total_child_benefit / (schedule.HICBC_end - schedule.HICBC_start), 0)
+
+    if do_student_loan:
+        marginal_rate = marginal_rate + np.where(gross_incomes >= student_loan_threshold, student_loan_rate, 0)
+
+    # the childcare subsidy and marriage allowance cliffs are jumps, not slopes, so don't affect the marginal rate
+    return marginal_rate
+
+
+def calculate_marginal_rate_segments(schedule, max_income, **options):
+    # total tax as a list of linear segments: segment i runs from "gross income from"[i] to "gross income to"[i],
+    # starts at "total tax/NI"[i] and rises at "marginal rate"[i]. Costs O(number of breakpoints), not O(incomes)
+    total_tax = total_tax_function(schedule, **options).restrict(0, max_income)
+    return {
+        "gross income from": total_tax.breakpoints,
+        "gross income to": np.append(total_tax.breakpoints[1:], max_income),
+        "total tax/NI": total_tax.values,
+        "marginal rate": total_tax.slopes,
+    }
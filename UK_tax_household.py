@@ -0,0 +1,157 @@
+import numpy as np
+import plotly.graph_objects as go
+from PIL import Image
+
+from UK_tax_engine import MAX_CELLS_PER_PASS, STUDENT_LOAN_RATE, STUDENT_LOAN_THRESHOLD, calculate_hicbc, calculate_personal_allowance, compile_schedule
+from UK_tax_library import load_datasets
+
+"""
+Two-earner households.
+
+UK_marginal_tax_rates looks at one person, so the parts of the system that depend on both partners' incomes are
+approximated: the marriage allowance is a 10% uplift to that person's own allowance, and HICBC and childcare
+eligibility look only at their own income. Here we evaluate a whole grid of (earner A, earner B) incomes at once:
+
+- income tax, NI and student loan are per person, so are worked out once along each axis and then broadcast
+- HICBC is charged on the higher earner's income
+- the marriage allowance is transferred from one partner to the other, if both are below the marriage allowance
+  earnings limit and it reduces the household's tax
+- the childcare subsidy needs both partners to earn more than the minimum, and neither more than the maximum
+
+Child benefit itself isn't added to net income, as in UK_marginal_tax_rates.
+"""
+
+DATASET = "rUK 2024-25"
+
+CHILDREN = 3
+
+INCLUDE_CHILD_BENEFIT = True
+INCLUDE_STUDENT_LOAN = False
+INCLUDE_CHILDCARE = True
+INCLUDE_MARRIAGE_ALLOWANCE = True
+
+# the grid of each earner's gross income, as UK_marginal_tax_rates
+RESOLUTION = 100
+MAX_INCOME = 180000
+
+LOGO_FILE = "logo_full_white_on_blue.jpg"
+
+# the marginal rate heatmap is capped here, as the childcare and marriage allowance cliffs are far higher
+HEATMAP_MAX_RATE = 100
+
+
+def individual_tax(gross_incomes, schedule, allowance_transfer=0.0, do_student_loan=False,
+                   student_loan_threshold=STUDENT_LOAN_THRESHOLD, student_loan_rate=STUDENT_LOAN_RATE):
+    # income tax, NI and student loan for one person, with allowance_transfer added to their personal allowance
+    # (negative for the partner giving it away)
+    personal_allowance = np.maximum(0, calculate_personal_allowance(gross_incomes, schedule, False) + allowance_transfer)
+    tax = schedule.income_tax.tax(np.maximum(0, gross_incomes - personal_allowance)) + schedule.NI.tax(gross_incomes)
+    if do_student_loan:
+        tax = tax + np.maximum(0, gross_incomes - student_loan_threshold) * student_loan_rate
+    return tax
+
+
+def calculate_household_tax(incomes_a, incomes_b, schedule, do_child_benefit=False, do_student_loan=False,
+                            children=0, include_childcare=False, include_marriage_allowance=False,
+                            student_loan_threshold=STUDENT_LOAN_THRESHOLD, student_loan_rate=STUDENT_LOAN_RATE):
+
+    # each element of the household's tax, shaped (len(incomes_a), len(incomes_b))
+    incomes_a = np.asarray(incomes_a, dtype=float)
+    incomes_b = np.asarray(incomes_b, dtype=float)
+    student_loan_options = dict(do_student_loan=do_student_loan, student_loan_threshold=student_loan_threshold, student_loan_rate=student_loan_rate)
+
+    tax_a = individual_tax(incomes_a, schedule, **student_loan_options)[:, np.newaxis]
+    tax_b = individual_tax(incomes_b, schedule, **student_loan_options)[np.newaxis, :]
+    individual_taxes = tax_a + tax_b
+
+    if include_marriage_allowance:
+        # either partner can transfer, so the household uses whichever way round (if either) costs least tax
+        transfer = schedule.statutory_personal_allowance * schedule.marriage_allowance
+        a_to_b = individual_tax(incomes_a, schedule, -transfer, **student_loan_options)[:, np.newaxis] + individual_tax(incomes_b, schedule, transfer, **student_loan_options)[np.newaxis, :]
+        b_to_a = individual_tax(incomes_a, schedule, transfer, **student_loan_options)[:, np.newaxis] + individual_tax(incomes_b, schedule, -transfer, **student_loan_options)[np.newaxis, :]
+        eligible = (incomes_a[:, np.newaxis] < schedule.marriage_allowance_max_earnings) & (incomes_b[np.newaxis, :] < schedule.marriage_allowance_max_earnings)
+        individual_taxes = np.where(eligible, np.minimum(individual_taxes, np.minimum(a_to_b, b_to_a)), individual_taxes)
+
+    higher_income = np.maximum(incomes_a[:, np.newaxis], incomes_b[np.newaxis, :])
+    lower_income = np.minimum(incomes_a[:, np.newaxis], incomes_b[np.newaxis, :])
+
+    if do_child_benefit and children > 0:
+        hicbc = calculate_hicbc(higher_income, schedule, children)
+    else:
+        hicbc = np.zeros_like(higher_income)
+
+    if include_childcare and children > 0:
+        eligible = (lower_income > schedule.childcare_min_earnings) & (higher_income < schedule.childcare_max_earnings)
+        childcare = np.where(eligible, schedule.childcare_subsidy_per_child * min(children, schedule.childcare_max_children), 0.0)
+    else:
+        childcare = np.zeros_like(higher_income)
+
+    return {"income tax/NI": individual_taxes, "HICBC": hicbc, "childcare": childcare}
+
+
+def combine_household_tax(components):
+    return components["income tax/NI"] + components["HICBC"] - components["childcare"]
+
+
+def calculate_household_surface(schedule, max_income, resolution, **options):
+    # household net income over a grid of both partners' incomes, and the marginal rate on each partner's next
+    # £resolution of earnings (as in UK_marginal_tax_rates, the change in tax from the previous grid point).
+    # Rows are earner A's income and columns earner B's
+    incomes = np.arange(0, max_income + resolution, resolution, dtype=float)
+    total_tax = np.empty((len(incomes), len(incomes)))
+
+    rows_per_pass = max(1, MAX_CELLS_PER_PASS // len(incomes))
+    for start in range(0, len(incomes), rows_per_pass):
+        rows = slice(start, start + rows_per_pass)
+        total_tax[rows] = combine_household_tax(calculate_household_tax(incomes[rows], incomes, schedule, **options))
+
+    marginal_rate_a = np.zeros_like(total_tax)
+    marginal_rate_a[1:, :] = np.diff(total_tax, axis=0) / resolution
+    marginal_rate_b = np.zeros_like(total_tax)
+    marginal_rate_b[:, 1:] = np.diff(total_tax, axis=1) / resolution
+
+    return {"gross income": incomes,
+            "total tax/NI": total_tax,
+            "net income": incomes[:, np.newaxis] + incomes[np.newaxis, :] - total_tax,
+            "marginal rate A": marginal_rate_a,
+            "marginal rate B": marginal_rate_b}
+
+
+def household_heatmap(surface, column, title, logo_layout=None, **heatmap_options):
+    incomes = surface["gross income"]
+    fig = go.Figure(go.Heatmap(x=incomes, y=incomes, z=surface[column], **heatmap_options))
+    fig.update_layout(
+                    title=title,
+                    title_font=dict(size=32),
+                    xaxis_title="Earner B's gross employment income (£)",
+                    xaxis_title_font=dict(size=18),
+                    yaxis_title="Earner A's gross employment income (£)",
+                    yaxis_title_font=dict(size=18),
+                    images=logo_layout
+                    )
+    fig.update_xaxes(tickprefix="£")
+    fig.update_yaxes(tickprefix="£")
+    return fig
+
+
+if __name__ == '__main__':
+
+    tax_data = load_datasets()
+    logo_layout = [dict(source=Image.open(LOGO_FILE), xref="paper", yref="paper", x=1, y=1.01, sizex=0.1, sizey=0.1,
+                        xanchor="right", yanchor="bottom")]
+
+    options = dict(do_child_benefit=INCLUDE_CHILD_BENEFIT,
+                   do_student_loan=INCLUDE_STUDENT_LOAN,
+                   children=CHILDREN,
+                   include_childcare=INCLUDE_CHILDCARE,
+                   include_marriage_allowance=INCLUDE_MARRIAGE_ALLOWANCE)
+
+    surface = calculate_household_surface(compile_schedule(tax_data[DATASET]), MAX_INCOME, RESOLUTION, **options)
+
+    household = f"{DATASET}, two earners, {CHILDREN} children"
+    household_heatmap(surface, "marginal rate A", f"Marginal tax rate on earner A's income ({household})", logo_layout,
+                      zmin=0, zmax=HEATMAP_MAX_RATE / 100, colorscale="Viridis",
+                      colorbar=dict(tickformat=".0%"), hovertemplate="A £%{y:,.0f}, B £%{x:,.0f}: %{z:.1%}<extra></extra>").show()
+    household_heatmap(surface, "net income", f"Household net income ({household})", logo_layout,
+                      colorscale="Viridis", colorbar=dict(tickprefix="£"),
+                      hovertemplate="A £%{y:,.0f}, B £%{x:,.0f}: £%{z:,.0f}<extra></extra>").show()
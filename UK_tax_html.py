@@ -0,0 +1,236 @@
+from dataclasses import fields
+import html
+import json
+import os
+import shutil
+
+import plotly.offline
+
+from UK_tax_engine import BandTable
+
+"""
+HTML output for the charts, with plotly.js loaded once rather than embedded in every page.
+
+fig.show() and a default fig.write_html() embed the whole plotly.js library (most of each ~4.4MB page) in every
+file. Here the library is written once, as a sibling file named after its version (so a reader's browser can cache
+it indefinitely, and an upgrade never mixes versions), and each page just refers to it. Several figures can also be
+written to one page, which then loads the library - and the logo, if it's linked rather than embedded - only once.
+"""
+
+
+def plotly_js_filename():
+    return f"plotly-{plotly.offline.get_plotlyjs_version()}.min.js"
+
+
+def write_plotly_js(directory):
+    # writes the plotly.js bundle into directory if it isn't already there; returns its filename
+    filename = plotly_js_filename()
+    path = os.path.join(directory, filename)
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(plotly.offline.get_plotlyjs())
+    return filename
+
+
+def copy_alongside(file_path, directory):
+    # so a page can link to e.g. the logo by its filename
+    destination = os.path.join(directory, os.path.basename(file_path))
+    if not os.path.exists(destination):
+        os.makedirs(directory, exist_ok=True)
+        shutil.copyfile(file_path, destination)
+    return os.path.basename(file_path)
+
+
+def write_figure_html(figure, path):
+    # one figure per page, sharing the plotly.js file with any other pages in the same directory
+    figure.write_html(path, include_plotlyjs=write_plotly_js(os.path.dirname(path) or "."))
+
+
+def write_figures_html(figures, path, title):
+    # several figures on one page, which loads plotly.js once
+    plotly_js = write_plotly_js(os.path.dirname(path) or ".")
+    divs = "\n".join(figure.to_html(full_html=False, include_plotlyjs=False) for figure in figures)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{html.escape(title)}</title>
+<script src="{plotly_js}"></script>
+</head>
+<body>
+{divs}
+</body>
+</html>
+""")
+
+
+"""
+Interactive charts evaluated in the browser.
+
+Rather than a sampled trace for every dataset and variant, the page holds each dataset's compiled TaxSchedule as
+json (a few hundred bytes) plus TAX_EVALUATOR_JS, a port of calculate_tax_components for one income. The browser
+samples the schedules itself, so the page stays the same size however many datasets are added, and readers can
+change the number of children, student loan and so on without the page being regenerated.
+
+TAX_EVALUATOR_JS has to be kept in step with UK_tax_engine; UK_tax_check checks that it is (if node is installed).
+"""
+
+TAX_EVALUATOR_JS = """
+function bandTax(bands, income) {
+    // as BandTable.tax: the band is the last one starting at or below income
+    let band = bands.t.length - 1;
+    while (band > 0 && bands.t[band] > income) band--;
+    return bands.c[band] + bands.r[band] * (income - bands.t[band]);
+}
+
+function totalTax(s, g, o) {
+    // as combine_total_tax(calculate_tax_components(g, s, **o)) for one gross income g
+    const taperApplies = g > s.allowance_withdrawal_threshold;
+    let allowance = taperApplies ? Math.max(0, s.statutory_personal_allowance - s.allowance_withdrawal_rate * (g - s.allowance_withdrawal_threshold))
+                                 : s.statutory_personal_allowance;
+    if (o.include_marriage_allowance && !taperApplies && g < s.marriage_allowance_max_earnings) {
+        allowance = s.statutory_personal_allowance * (1 + s.marriage_allowance);
+    }
+    let tax = bandTax(s.income_tax, Math.max(0, g - allowance)) + bandTax(s.NI, g);
+
+    if (o.do_child_benefit && o.children > 0 && g >= s.HICBC_start) {
+        const childBenefit = 52 * (s.child_benefit_first + s.child_benefit_subsequent * (o.children - 1));
+        tax += g > s.HICBC_end ? childBenefit : childBenefit * (g - s.HICBC_start) / (s.HICBC_end - s.HICBC_start);
+    }
+    if (o.include_childcare && o.children > 0 && s.childcare_min_earnings < g && g < s.childcare_max_earnings) {
+        tax -= s.childcare_subsidy_per_child * Math.min(o.children, s.childcare_max_children);
+    }
+    if (o.do_student_loan) {
+        tax += Math.max(0, g - o.student_loan_threshold) * o.student_loan_rate;
+    }
+    return tax;
+}
+
+function taxTraces(s, o, maxIncome, resolution) {
+    // as UK_tax_library.calculate_tax: a point every resolution, the marginal rate from the change since the last
+    const x = [], netIncome = [], marginalRate = [];
+    let previousTax = 0;
+    for (let i = 0; i * resolution <= maxIncome; i++) {
+        const g = i * resolution, tax = totalTax(s, g, o);
+        x.push(g);
+        netIncome.push(g - tax);
+        marginalRate.push(i === 0 ? 0 : 100 * (tax - previousTax) / resolution);
+        previousTax = tax;
+    }
+    return {x: x, netIncome: netIncome, marginalRate: marginalRate};
+}
+"""
+
+INTERACTIVE_PAGE_JS = """
+const CONTROLS = ["children", "do_child_benefit", "do_student_loan", "include_childcare", "include_marriage_allowance"];
+
+function readOptions() {
+    const o = Object.assign({}, PAGE.options);
+    for (const name of CONTROLS) {
+        const control = document.getElementById(name);
+        o[name] = control.type === "checkbox" ? control.checked : Math.max(0, parseInt(control.value, 10) || 0);
+    }
+    return o;
+}
+
+function layout(title, yAxis) {
+    return {title: {text: title, font: {size: 32}},
+            xaxis: {title: {text: "Gross employment income (£)", font: {size: 18}}, tickprefix: "£"},
+            yaxis: Object.assign({title: {font: {size: 18}}}, yAxis),
+            hovermode: "x",
+            images: PAGE.logo ? [{source: PAGE.logo, xref: "paper", yref: "paper", x: 1, y: 1.01, sizex: 0.1, sizey: 0.1, xanchor: "right", yanchor: "bottom"}] : [],
+            legend: {orientation: "h", yanchor: "top", y: -0.075, xanchor: "center", x: 0.5, bordercolor: "Black", borderwidth: 1}};
+}
+
+function visibility(div, dataset) {
+    // keep whichever datasets the reader has turned on or off in the legend
+    const trace = (div.data || []).find(trace => trace.name === dataset);
+    return trace ? trace.visible : (dataset === PAGE.default_dataset ? true : "legendonly");
+}
+
+function draw() {
+    const o = readOptions();
+    const marginalRateDiv = document.getElementById("marginal_rate"), netIncomeDiv = document.getElementById("net_income");
+    const marginalRateTraces = [], netIncomeTraces = [];
+    for (const [dataset, schedule] of Object.entries(PAGE.schedules)) {
+        const traces = taxTraces(schedule, o, PAGE.max_income, PAGE.resolution);
+        marginalRateTraces.push({x: traces.x, y: traces.marginalRate, mode: "lines", name: dataset, hovertemplate: "%{y:.2f}%",
+                                 visible: visibility(marginalRateDiv, dataset)});
+        netIncomeTraces.push({x: traces.x, y: traces.netIncome, mode: "lines", name: dataset, hovertemplate: "£%{y:,.0f}",
+                              visible: visibility(netIncomeDiv, dataset)});
+    }
+
+    let suffix = "";
+    if (o.include_childcare) suffix += ", inc childcare subsidy";
+    if (o.include_marriage_allowance) suffix += ", inc marriage allowance";
+    // as the python charts, the childcare and marriage allowance cliffs would otherwise set the scale
+    const rateAxis = (o.include_childcare || o.include_marriage_allowance) ? {autorange: true} : {range: [0, 90]};
+    Plotly.react(marginalRateDiv, marginalRateTraces,
+                 layout("Marginal tax rate" + suffix, Object.assign({title: {text: "Marginal rate (%)", font: {size: 18}}, ticksuffix: "%"}, rateAxis)));
+    Plotly.react(netIncomeDiv, netIncomeTraces,
+                 layout("Gross employment income vs net income" + suffix, {title: {text: "Net income (£)", font: {size: 18}}, tickprefix: "£"}));
+}
+
+for (const name of CONTROLS) document.getElementById(name).addEventListener("change", draw);
+draw();
+"""
+
+
+def schedule_as_json(schedule):
+    # a compiled TaxSchedule as a dict for TAX_EVALUATOR_JS, with each BandTable as {t: thresholds, r: rates, c: cumulative tax}
+    schedule_dict = {}
+    for schedule_field in fields(schedule):
+        name, value = schedule_field.name, getattr(schedule, schedule_field.name)
+        if isinstance(value, BandTable):
+            schedule_dict[name] = {"t": value.lower_thresholds, "r": value.rates, "c": value.cumulative_tax}
+        else:
+            schedule_dict[name] = value
+    return schedule_dict
+
+
+def write_interactive_html(schedules, path, title, default_dataset, options, max_income, resolution, logo=None):
+    # one page drawing the marginal rate and net income of every schedule in the dict {dataset: TaxSchedule}, with
+    # controls for children, child benefit, student loan, childcare and marriage allowance initially set from
+    # options (a TaxOptions). logo is a path to an image, copied alongside the page
+    directory = os.path.dirname(path) or "."
+    plotly_js = write_plotly_js(directory)
+    page_data = {"schedules": {dataset: schedule_as_json(schedule) for dataset, schedule in schedules.items()},
+                 "options": options.as_kwargs(),
+                 "default_dataset": default_dataset,
+                 "max_income": max_income,
+                 "resolution": resolution,
+                 "logo": copy_alongside(logo, directory) if logo else None}
+    # "</" escaped so that nothing in the data can close the script tag
+    page_json = json.dumps(page_data, separators=(",", ":")).replace("</", "<\\/")
+    checked = {name: " checked" if getattr(options, name) else "" for name in ("do_child_benefit", "do_student_loan", "include_childcare", "include_marriage_allowance")}
+
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{html.escape(title)}</title>
+<script src="{plotly_js}"></script>
+</head>
+<body>
+<form onsubmit="return false" style="font-family: sans-serif">
+<label>Children <input type="number" id="children" min="0" max="20" value="{int(options.children)}" style="width: 4em"></label>
+<label><input type="checkbox" id="do_child_benefit"{checked["do_child_benefit"]}> Child benefit</label>
+<label><input type="checkbox" id="do_student_loan"{checked["do_student_loan"]}> Student loan</label>
+<label><input type="checkbox" id="include_childcare"{checked["include_childcare"]}> Childcare subsidy</label>
+<label><input type="checkbox" id="include_marriage_allowance"{checked["include_marriage_allowance"]}> Marriage allowance</label>
+</form>
+<div id="marginal_rate" style="height: 90vh"></div>
+<div id="net_income" style="height: 90vh"></div>
+<script>
+const PAGE = {page_json};
+{TAX_EVALUATOR_JS}
+{INTERACTIVE_PAGE_JS}
+</script>
+</body>
+</html>
+""")
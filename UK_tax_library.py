@@ -0,0 +1,256 @@
+import json
+from dataclasses import asdict, dataclass, replace
+from functools import lru_cache
+
+import numpy as np
+
+from UK_tax_engine import (STUDENT_LOAN_RATE, STUDENT_LOAN_THRESHOLD, TaxSchedule, calculate_marginal_rate_segments, calculate_marginal_rates,
+                           calculate_tax_components, combine_income_tax, combine_total_tax, compile_schedule, net_income_function,
+                           tax_functions)
+
+"""
+Library API for the calculations in UK_marginal_tax_rates and UK_tax_change_calculator.
+
+Those scripts take their settings (CHILDREN, INCLUDE_CHILDCARE, the ETIs and so on) from globals at the top of the
+file, and their datasets from a tax_data global that only exists when they're run directly. Here everything is an
+explicit argument instead: a dataset (its json dict, or a compiled TaxSchedule) and a frozen options object.
+Nothing in this module reads or writes global state, so it can be imported into a long-lived process and called
+from several threads, or process pool workers, with different settings at once.
+
+The scripts' own functions now call these, with options built from their settings.
+
+pandas is only imported when a dataframe is actually built, so that callers that only need numbers (e.g.
+UK_tax_cli's calc command, or the service) don't pay for it at start-up.
+"""
+
+DATASET_FILENAME = "UK_marginal_tax_datasets.json"
+
+# this uses the ETIs recommended by the Scottish Fiscal Commission. The Scottish figures will be higher than for the rest of the UK
+# given the obvious propoensity for Scottish taxpayers to move to England... this therefore likely represents an over-estimate
+# https://www.fiscalcommission.scot/publications/how-we-forecast-behavioural-responses-to-income-tax-policy-march-2018/
+DEFAULT_ELASTICITY_OF_TAXABLE_INCOME = {
+                                        50000: 0.015,
+                                        80000: 0.10,
+                                        150000: 0.20,
+                                        300000: 0.35,
+                                        500000: 0.55,
+                                        1e9: 0.75
+                                        }
+
+# number of taxpayers for 2025/26 from row 9 table 3.7 here https://obr.uk/efo/economic-and-fiscal-outlook-march-2024/
+DEFAULT_POPULATION_OF_TAXPAYERS = 37800000
+
+
+@dataclass(frozen=True)
+class TaxOptions:
+    # what to include when calculating one person's tax (as the settings at the top of UK_marginal_tax_rates)
+    do_child_benefit: bool = False
+    do_student_loan: bool = False
+    children: int = 0
+    include_childcare: bool = False
+    include_marriage_allowance: bool = False
+    student_loan_threshold: float = STUDENT_LOAN_THRESHOLD
+    student_loan_rate: float = STUDENT_LOAN_RATE
+
+    def as_kwargs(self):
+        # for the UK_tax_engine functions
+        return asdict(self)
+
+
+@dataclass(frozen=True)
+class CostingOptions:
+    # assumptions for costing a policy change (as the settings at the top of UK_tax_change_calculator).
+    # elasticity_table can be given as a dict of {income threshold: ETI}; it's kept as sorted (threshold, ETI) pairs
+    elasticity_table: tuple = tuple(DEFAULT_ELASTICITY_OF_TAXABLE_INCOME.items())
+    eti_sensitivity_factor: float = 1.0
+    interpolate_eti: bool = False
+    exact_marginal_rates: bool = True
+    gross_income_perturbation: float = 1000
+    population_of_taxpayers: float = DEFAULT_POPULATION_OF_TAXPAYERS
+
+    def __post_init__(self):
+        object.__setattr__(self, "elasticity_table", tuple(sorted(dict(self.elasticity_table).items())))
+
+
+def load_datasets(filename=DATASET_FILENAME):
+    # unlike the scripts' load_data_from_json, a missing or broken file raises rather than exiting
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def as_schedule(dataset):
+    # a dataset's json dict, or an already compiled TaxSchedule
+    return dataset if isinstance(dataset, TaxSchedule) else compile_schedule(dataset)
+
+
+def calculate_tax(dataset, gross_incomes, options=TaxOptions()):
+    # one row per gross income, with the marginal rate worked out from the change in tax since the previous row
+    gross_incomes = np.asarray(gross_incomes)
+    components = calculate_tax_components(gross_incomes, as_schedule(dataset), **options.as_kwargs())
+    total_tax_ni = combine_total_tax(components)
+    marginal_rate = np.concatenate(([0], np.diff(total_tax_ni) / np.diff(gross_incomes)))
+    return tax_dataframe(gross_incomes, components, marginal_rate)
+
+
+def calculate_tax_exact(dataset, max_income, options=TaxOptions()):
+    # a row only at each breakpoint (plus max_income), with the exact marginal rate on the next £ earned from that point
+    schedule = as_schedule(dataset)
+    segments = calculate_marginal_rate_segments(schedule, max_income, **options.as_kwargs())
+    gross_incomes = np.append(segments["gross income from"], max_income)
+
+    tax_and_ni_functions = tax_functions(schedule, **options.as_kwargs())
+    components = {name: function(gross_incomes) for name, function in tax_and_ni_functions.items()}
+    return tax_dataframe(gross_incomes, components, np.append(segments["marginal rate"], segments["marginal rate"][-1]))
+
+
+def calculate_breakpoint_traces(dataset, max_income, options=TaxOptions()):
+    # the points needed to draw each line exactly, rather than a point every £100. Net income is linear between
+    # breakpoints, so needs only those (plus the value just before any jump, e.g. the childcare cliff); the marginal
+    # rate is constant between them, so is drawn as steps (plotly line_shape "hv")
+    schedule = as_schedule(dataset)
+    segments = calculate_marginal_rate_segments(schedule, max_income, **options.as_kwargs())
+
+    net_income = net_income_function(schedule, **options.as_kwargs()).restrict(0, max_income)
+    net_income_x = [net_income.breakpoints[0]]
+    net_income_y = [net_income.values[0]]
+    for breakpoint, value, value_before in zip(net_income.breakpoints[1:], net_income.values[1:], net_income.segment_ends()):
+        if not np.isclose(value, value_before, rtol=0, atol=1e-6):
+            net_income_x.append(breakpoint)
+            net_income_y.append(value_before)
+        net_income_x.append(breakpoint)
+        net_income_y.append(value)
+    net_income_x.append(max_income)
+    net_income_y.append(float(net_income(max_income)))
+
+    return {"marginal rate": (np.append(segments["gross income from"], max_income), np.append(segments["marginal rate"], segments["marginal rate"][-1])),
+            "net income": (np.array(net_income_x), np.array(net_income_y))}
+
+
+def calculate_breakdown(dataset, gross_incomes, options=TaxOptions()):
+    # every element of the calculation, and the exact marginal rate, as a dict of arrays - for callers that want
+    # numbers rather than a dataframe (UK_tax_service's responses, UK_tax_cli's calc command)
+    schedule = as_schedule(dataset)
+    gross_incomes = np.asarray(gross_incomes, dtype=float)
+    components = calculate_tax_components(gross_incomes, schedule, **options.as_kwargs())
+    income_tax = combine_income_tax(components)
+    total_tax_ni = income_tax + components["NI"]
+    return {"gross income": gross_incomes,
+            "income tax": income_tax,
+            "employee NI": components["NI"],
+            "HICBC": components["HICBC"],
+            "student loan": components["student loan"],
+            "childcare subsidy": components["childcare"],
+            "total tax/NI": total_tax_ni,
+            "net income": gross_incomes - total_tax_ni,
+            "marginal rate": calculate_marginal_rates(gross_incomes, schedule, **options.as_kwargs())}
+
+
+def tax_dataframe(gross_incomes, components, marginal_rate):
+    import pandas as pd
+
+    income_tax = combine_income_tax(components)
+    employee_ni = components["NI"]
+    total_tax_ni = income_tax + employee_ni
+    return pd.DataFrame({"gross income": gross_incomes,
+                         "income tax": income_tax,
+                         "employee NI": employee_ni,
+                         "total tax/NI": total_tax_ni,
+                         "net income": gross_incomes - total_tax_ni,
+                         "marginal rate": marginal_rate})
+
+
+# sorted thresholds and ETIs for an ETI table, plus the points the interpolated curve passes through.
+# Worked out once per table
+@lru_cache(maxsize=64)
+def compile_elasticity_table(table_items):
+    income_thresholds = np.array(sorted(threshold for threshold, _ in table_items), dtype=float)
+    elasticities = np.array([dict(table_items)[threshold] for threshold in income_thresholds])
+
+    band_starts = np.concatenate(([0.0], income_thresholds[:-1]))
+    curve_incomes = np.append((band_starts[:-1] + income_thresholds[:-1]) / 2, band_starts[-1])
+
+    for array in (income_thresholds, elasticities, curve_incomes):
+        array.flags.writeable = False
+    return income_thresholds, elasticities, curve_incomes
+
+
+def find_elasticities(gross_incomes, costing=CostingOptions()):
+    income_thresholds, elasticities, curve_incomes = compile_elasticity_table(costing.elasticity_table)
+    if costing.interpolate_eti:
+        return costing.eti_sensitivity_factor * np.interp(gross_incomes, curve_incomes, elasticities)
+
+    # first threshold at or above each income, or the highest threshold if there isn't one
+    threshold_index = np.minimum(np.searchsorted(income_thresholds, gross_incomes, side="left"), len(income_thresholds) - 1)
+    return costing.eti_sensitivity_factor * elasticities[threshold_index]
+
+
+def total_tax(gross_incomes, schedule):
+    # total tax and NI, with none of the optional elements (as UK_tax_change_calculator costs policy changes)
+    return combine_total_tax(calculate_tax_components(gross_incomes, schedule))
+
+
+def marginal_rates(gross_incomes, schedule, costing=CostingOptions(), total_tax_already_calculated=None):
+    # the rate of tax and NI on the next £ of gross income, exactly or by perturbing gross income
+    if costing.exact_marginal_rates:
+        return calculate_marginal_rates(gross_incomes, schedule)
+
+    if total_tax_already_calculated is None:
+        total_tax_already_calculated = total_tax(gross_incomes, schedule)
+    return (total_tax(np.asarray(gross_incomes) + costing.gross_income_perturbation, schedule) - total_tax_already_calculated) / costing.gross_income_perturbation
+
+
+def calculate_baseline(gross_incomes, schedule_initial, costing=CostingOptions()):
+    # the starting position, which doesn't depend on the policy change - see UK_tax_change_calculator
+    gross_incomes = np.asarray(gross_incomes, dtype=float)
+    total_tax_initial = total_tax(gross_incomes, schedule_initial)
+    marginal_rate_initial = marginal_rates(gross_incomes, schedule_initial, costing, total_tax_initial)
+    return {"current tax": total_tax_initial, "marginal rate": marginal_rate_initial}
+
+
+def calculate_effect_of_change(gross_incomes, schedule_initial, schedule_policy_change, costing=CostingOptions(), baseline=None, elasticity=None):
+    # the UK_tax_change_calculator methodology for every gross income at once, returning a dict of numpy columns.
+    # elasticity can be given as an array, shaped (incomes,) or (ETI variants, incomes), instead of being looked up
+    gross_incomes = np.asarray(gross_incomes, dtype=float)
+
+    if baseline is None:
+        baseline = calculate_baseline(gross_incomes, schedule_initial, costing)
+    total_tax_initial = baseline["current tax"]
+    marginal_rate_initial = baseline["marginal rate"]
+    retention_rate_initial = 1 - marginal_rate_initial
+
+    total_tax_after_policy_change = total_tax(gross_incomes, schedule_policy_change)
+    marginal_rate_after_policy_change = marginal_rates(gross_incomes, schedule_policy_change, costing, total_tax_after_policy_change)
+    retention_rate_after_policy_change = 1 - marginal_rate_after_policy_change
+
+    percentage_change_in_marginal_retention_rate = (retention_rate_after_policy_change - retention_rate_initial) / retention_rate_initial
+    if elasticity is None:
+        elasticity = find_elasticities(gross_incomes, costing)
+    percentage_change_in_taxable_income = percentage_change_in_marginal_retention_rate * elasticity
+
+    dynamic_gross_income = gross_incomes * (1 + percentage_change_in_taxable_income)
+    dynamic_tax_after_policy_change = total_tax(dynamic_gross_income, schedule_policy_change)
+
+    return {
+        "gross income": gross_incomes,
+        "current tax": total_tax_initial,
+        "marginal rate": marginal_rate_initial,
+        "retention rate": retention_rate_initial,
+        "new tax (static)": total_tax_after_policy_change,
+        "new marginal rate": marginal_rate_after_policy_change,
+        "new retention rate": retention_rate_after_policy_change,
+        "ETI": elasticity,
+        "dynamic gross income": dynamic_gross_income,
+        "new tax (dynamic)": dynamic_tax_after_policy_change,
+        "static tax change": total_tax_after_policy_change - total_tax_initial,
+        "dynamic tax change": dynamic_tax_after_policy_change - total_tax_initial,
+    }
+
+
+def total_revenue_change(tax_change, costing=CostingOptions()):
+    # each of the 99 percentile points stands for 1% of taxpayers; £bn. Sums over the last axis
+    return np.sum(tax_change, axis=-1) * costing.population_of_taxpayers / 100 / 1e9
+
+
+def with_costing_changes(costing, **changes):
+    # a copy of costing with some options changed, e.g. with_costing_changes(costing, eti_sensitivity_factor=1.5)
+    return replace(costing, **changes)
@@ -0,0 +1,105 @@
+import os
+import time
+
+import numpy as np
+
+from UK_tax_cache import content_hash, write_atomically
+from UK_tax_engine import calculate_marginal_rates, calculate_tax_components, combine_total_tax, compile_schedule
+from UK_tax_library import TaxOptions, load_datasets
+
+"""
+Precomputed lookup tables, so a gross -> net query for the busiest datasets is one array index.
+
+For each dataset (and set of options) total tax, net income and marginal rate are calculated for every whole £ of
+gross income up to a maximum, and saved as a .npy file with one row per £. The files are memory-mapped rather than
+read, so opening them is instant, only the pages actually used are read from disk, and every process that maps
+the same file (e.g. several service workers) shares one copy in the OS page cache.
+
+Each file is named after a content hash of the dataset's json and the options, so a table is rebuilt - never
+reused stale - when the dataset changes, and the table it replaces is deleted.
+
+Run this file to build the tables for LOOKUP_DATASETS ahead of time.
+"""
+
+LOOKUP_DATASETS = ["rUK 2024-25", "Scot 2024-25"]
+
+# tables cover every whole £ from 0 to this (each £100,000 is 2.4MB per dataset)
+LOOKUP_MAX_INCOME = 500000
+
+LOOKUP_TABLE_DIRECTORY = ".tax_lookup"
+
+LOOKUP_TABLE_VERSION = 1   # increase if the calculation itself changes, so old tables aren't reused
+
+# the columns of each row
+LOOKUP_COLUMNS = ("total tax/NI", "net income", "marginal rate")
+
+
+def calculate_lookup_table(schedule, max_income, options=TaxOptions()):
+    # row i is for gross income £i
+    gross_incomes = np.arange(0, int(max_income) + 1, dtype=float)
+    total_tax_ni = combine_total_tax(calculate_tax_components(gross_incomes, schedule, **options.as_kwargs()))
+    marginal_rate = calculate_marginal_rates(gross_incomes, schedule, **options.as_kwargs())
+    return np.column_stack((total_tax_ni, gross_incomes - total_tax_ni, marginal_rate))
+
+
+class LookupTable:
+    # a memory-mapped table for one dataset and set of options
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = np.load(path, mmap_mode="r")
+        self.max_income = len(self.rows) - 1
+
+    def covers(self, gross_income):
+        return 0 <= gross_income <= self.max_income and gross_income == int(gross_income)
+
+    def lookup(self, gross_income):
+        # dict of LOOKUP_COLUMNS for a whole-£ gross income the table covers
+        return dict(zip(LOOKUP_COLUMNS, self.rows[int(gross_income)].tolist()))
+
+
+def lookup_table_prefix(dataset, max_income, options):
+    # every table for this dataset name and these settings starts with this, whatever the dataset's json
+    group = content_hash(dataset, options.as_kwargs(), int(max_income), LOOKUP_TABLE_VERSION)[:16]
+    safe_name = "".join(character if character.isalnum() else "_" for character in dataset)
+    return f"{safe_name}-{group}-"
+
+
+def lookup_table_path(directory, dataset, relevant_data, max_income, options):
+    key = content_hash(relevant_data)[:16]
+    return os.path.join(directory, f"{lookup_table_prefix(dataset, max_income, options)}{key}.npy")
+
+
+def remove_stale_lookup_tables(directory, dataset, max_income, options, current_path):
+    # tables for the same dataset and settings but an older version of its json, which can't be used again
+    prefix = lookup_table_prefix(dataset, max_income, options)
+    for filename in os.listdir(directory):
+        if filename.startswith(prefix) and filename.endswith(".npy") and filename != os.path.basename(current_path):
+            try:
+                os.remove(os.path.join(directory, filename))
+            except FileNotFoundError:
+                pass   # another process got there first
+
+
+def load_or_build_lookup_table(dataset, relevant_data, max_income=LOOKUP_MAX_INCOME, options=TaxOptions(), directory=LOOKUP_TABLE_DIRECTORY):
+    path = lookup_table_path(directory, dataset, relevant_data, max_income, options)
+    if not os.path.exists(path):
+        table = calculate_lookup_table(compile_schedule(relevant_data), max_income, options)
+        write_atomically(path, lambda f: np.save(f, table))
+        remove_stale_lookup_tables(directory, dataset, max_income, options, path)
+    return LookupTable(path)
+
+
+def load_or_build_lookup_tables(tax_data, datasets=LOOKUP_DATASETS, max_income=LOOKUP_MAX_INCOME, options_list=(TaxOptions(),), directory=LOOKUP_TABLE_DIRECTORY):
+    # {(dataset, options): LookupTable}
+    return {(dataset, options): load_or_build_lookup_table(dataset, tax_data[dataset], max_income, options, directory)
+            for dataset in datasets for options in options_list}
+
+
+if __name__ == '__main__':
+
+    tax_data = load_datasets()
+    for dataset in LOOKUP_DATASETS:
+        start_time = time.perf_counter()
+        table = load_or_build_lookup_table(dataset, tax_data[dataset])
+        print(f"{dataset}: £0 to £{table.max_income:,} in {table.path} ({os.path.getsize(table.path) / 1e6:.1f}MB, {time.perf_counter() - start_time:.2f}s)")
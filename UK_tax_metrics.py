@@ -0,0 +1,121 @@
+import bisect
+
+"""
+Minimal metrics in the Prometheus text exposition format, for UK_tax_service's /metrics endpoint.
+
+Each metric keeps its values in a dict keyed by the tuple of label values, so recording one is a dict lookup and
+an add (plus a bisect for a histogram) - cheap enough to leave on. Metrics aren't locked: record them from one
+thread (the service's event loop).
+"""
+
+# seconds; from well under the single-query target of 1ms up to a slow batch
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096, 16384, 65536, 262144)
+
+
+def format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    type_name = "counter"
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        for label_values, value in sorted(self.values.items()):
+            yield self.name, format_labels(self.label_names, label_values), value
+
+
+class Gauge(Counter):
+    type_name = "gauge"
+
+    def set(self, *label_values, value):
+        self.values[label_values] = value
+
+
+class CallbackMetric:
+    # a value that something else already counts (e.g. ResultCache's hits), read when the metrics are rendered
+    def __init__(self, name, documentation, callback, type_name="gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.type_name = type_name
+
+    def samples(self):
+        yield self.name, "", self.callback()
+
+
+class Histogram:
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # label values -> [count in each bucket (the last being +Inf), sum, count]
+        self.values = {}
+
+    def observe(self, value, *label_values):
+        entry = self.values.get(label_values)
+        if entry is None:
+            entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def samples(self):
+        for label_values, (bucket_counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self.buckets + ("+Inf",), bucket_counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", format_labels(self.label_names, label_values, [("le", upper_bound)]), cumulative
+            yield f"{self.name}_sum", format_labels(self.label_names, label_values), total
+            yield f"{self.name}_count", format_labels(self.label_names, label_values), count
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=()):
+        return self.register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def callback(self, name, documentation, callback, type_name="gauge"):
+        return self.register(CallbackMetric(name, documentation, callback, type_name))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            lines += [f"{name}{labels} {format_value(value)}" for name, labels, value in metric.samples()]
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,108 @@
+import time
+
+import numpy as np
+
+import UK_tax_change_calculator as calculator
+import UK_tax_library as library
+from UK_tax_engine import compile_schedule
+
+"""
+Microsimulation version of the revenue estimate in UK_tax_change_calculator.
+
+Rather than treating each of the 99 percentile points as 1% of taxpayers, we draw synthetic taxpayers from the
+income distribution the percentile points describe, run them all through the array engine (in chunks, so memory
+stays bounded however many we draw) and add up the static and dynamic revenue, with a confidence interval for
+the sampling error.
+
+Between the 1st and 99th percentiles the distribution is interpolated linearly. Below the 1st it's extrapolated
+linearly (floored at zero). Above the 99th, where much of the income tax is paid, it has a Pareto tail fitted to
+the 90th and 99th percentile points - so this will give a larger (and likely more realistic) figure than the
+percentile method, which in effect assumes nobody earns more than the 99th percentile.
+"""
+
+# number of synthetic taxpayers to draw. Up to POPULATION_OF_TAXPAYERS (i.e. one per taxpayer) is reasonable
+NUMBER_OF_TAXPAYERS = 1000000
+
+# how many taxpayers to calculate at once; limits memory use to roughly 250 bytes x this, as calculate_effect_of_change
+# keeps about a dozen float64 columns for each taxpayer, plus temporaries while it works them out
+CHUNK_SIZE = 1000000
+
+RANDOM_SEED = 2024
+
+# Pareto tail fitted between this percentile point and the highest one
+PARETO_FIT_FROM_PERCENTILE = 90
+
+# 95% confidence intervals
+CONFIDENCE_Z = 1.96
+
+
+def fit_pareto_alpha(percentile_points, percentile_incomes, fit_from_percentile=PARETO_FIT_FROM_PERCENTILE):
+    # for a Pareto distribution, income at quantile p is proportional to (1 - p) ** (-1 / alpha)
+    fit_from = np.searchsorted(percentile_points, fit_from_percentile / 100)
+    return np.log((1 - percentile_points[fit_from]) / (1 - percentile_points[-1])) / np.log(percentile_incomes[-1] / percentile_incomes[fit_from])
+
+
+def income_at_quantiles(quantiles, percentile_points, percentile_incomes, pareto_alpha):
+    # inverse cumulative distribution function: quantiles in [0, 1) to gross incomes
+    incomes = np.interp(quantiles, percentile_points, percentile_incomes)
+
+    below = quantiles < percentile_points[0]
+    lowest_slope = (percentile_incomes[1] - percentile_incomes[0]) / (percentile_points[1] - percentile_points[0])
+    incomes[below] = np.maximum(0, percentile_incomes[0] + lowest_slope * (quantiles[below] - percentile_points[0]))
+
+    above = quantiles > percentile_points[-1]
+    incomes[above] = percentile_incomes[-1] * ((1 - percentile_points[-1]) / (1 - quantiles[above])) ** (1 / pareto_alpha)
+
+    return incomes
+
+
+def run_microsimulation(schedule_initial, schedule_policy_change, number_of_taxpayers=NUMBER_OF_TAXPAYERS,
+                        chunk_size=CHUNK_SIZE, seed=RANDOM_SEED, costing=None):
+    # by default costs with UK_tax_change_calculator's settings
+    if costing is None:
+        costing = calculator.costing_options()
+
+    percentiles, gross_incomes = calculator.load_percentile_incomes()
+    percentile_points = np.asarray(percentiles, dtype=float) / 100
+    pareto_alpha = fit_pareto_alpha(percentile_points, gross_incomes)
+
+    rng = np.random.default_rng(seed)
+    start_time = time.perf_counter()
+
+    # running totals of the per-taxpayer change in tax, and its square, for the mean and its standard error
+    totals = {"static tax change": 0.0, "dynamic tax change": 0.0}
+    totals_of_squares = {"static tax change": 0.0, "dynamic tax change": 0.0}
+
+    for chunk_start in range(0, number_of_taxpayers, chunk_size):
+        chunk_incomes = income_at_quantiles(rng.random(min(chunk_size, number_of_taxpayers - chunk_start)), percentile_points, gross_incomes, pareto_alpha)
+        results = library.calculate_effect_of_change(chunk_incomes, schedule_initial, schedule_policy_change, costing)
+        for column in totals:
+            totals[column] += np.sum(results[column])
+            totals_of_squares[column] += np.sum(np.square(results[column]))
+
+    # scale the sample mean up to the whole taxpayer population; £bn
+    summary = {"number of taxpayers": number_of_taxpayers, "pareto alpha": float(pareto_alpha)}
+    for column in totals:
+        mean = totals[column] / number_of_taxpayers
+        variance = max(0.0, totals_of_squares[column] / number_of_taxpayers - mean ** 2)
+        standard_error = float(np.sqrt(variance / number_of_taxpayers))
+        estimate = float(mean) * costing.population_of_taxpayers / 1e9
+        margin = CONFIDENCE_Z * standard_error * costing.population_of_taxpayers / 1e9
+        summary[column] = (estimate, estimate - margin, estimate + margin)
+
+    summary["seconds"] = time.perf_counter() - start_time
+    return summary
+
+
+if __name__ == '__main__':
+
+    tax_data = calculator.load_data_from_json()
+
+    summary = run_microsimulation(compile_schedule(tax_data[calculator.DATASET_INITIAL]),
+                                  compile_schedule(tax_data[calculator.DATASET_POLICY_CHANGE]))
+
+    print(f"Microsimulation of '{calculator.DATASET_POLICY_CHANGE}' compared to '{calculator.DATASET_INITIAL}'")
+    print(f"{summary['number of taxpayers']:,} synthetic taxpayers, Pareto tail alpha {summary['pareto alpha']:.2f}, {summary['seconds']:.1f} seconds")
+    for label, column in [("Static", "static tax change"), ("Dynamic", "dynamic tax change")]:
+        estimate, low, high = summary[column]
+        print(f"{label} estimate: £{estimate:,.1f}bn (95% confidence interval £{low:,.1f}bn to £{high:,.1f}bn)")
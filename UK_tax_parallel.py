@@ -0,0 +1,126 @@
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+import UK_tax_change_calculator as calculator
+import UK_tax_library as library
+from UK_tax_engine import MAX_CELLS_PER_PASS, stack_schedules
+
+"""
+Process pool for sweeps too big for one core, e.g. many schedule variants over a microsimulated population.
+
+The taxpayers' incomes and weights are put in shared memory once, and each worker process attaches to them when
+it starts. A task is then just a few compiled schedules (a few hundred bytes each) and comes back as one revenue
+figure per schedule, so no large array is ever pickled between processes.
+
+The costing settings are passed to the workers as a CostingOptions object, rather than each worker reading
+UK_tax_change_calculator's globals (which, in a freshly started worker, would be the defaults, not the caller's).
+"""
+
+
+# memory the workers may use between them for their (scenario x taxpayer) grids, in bytes
+MEMORY_LIMIT = 2e9
+
+# bytes used per (scenario x taxpayer) cell by calculate_effect_of_change: a dozen or so float64 results, plus
+# temporaries (measured peak)
+BYTES_PER_CELL = 160
+
+
+class SharedArray:
+    # a numpy array in shared memory. Pickles as just its name, shape and dtype, so can be passed to workers cheaply
+
+    def __init__(self, array):
+        array = np.ascontiguousarray(array)
+        self.shape = array.shape
+        self.dtype = array.dtype.str
+        self._memory = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        self.name = self._memory.name
+        np.ndarray(self.shape, dtype=self.dtype, buffer=self._memory.buf)[...] = array
+
+    def __getstate__(self):
+        return {"name": self.name, "shape": self.shape, "dtype": self.dtype}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._memory = None
+
+    def attach(self):
+        # read-only view of the array, from any process
+        if self._memory is None:
+            # only the process that created the memory should remove it, not each worker as it exits. Before
+            # python 3.13 attaching always registers with the resource tracker, so it has to be undone afterwards
+            if sys.version_info >= (3, 13):
+                self._memory = shared_memory.SharedMemory(name=self.name, track=False)
+            else:
+                self._memory = shared_memory.SharedMemory(name=self.name)
+                resource_tracker.unregister(self._memory._name, "shared_memory")
+        array = np.ndarray(self.shape, dtype=self.dtype, buffer=self._memory.buf)
+        array.flags.writeable = False
+        return array
+
+    def release(self):
+        # called by the creating process once the workers are finished
+        self._memory.close()
+        self._memory.unlink()
+
+
+# set in each worker process by _start_worker
+_worker_state = {}
+
+
+def _start_worker(shared_incomes, shared_weights, schedule_initial, costing, max_cells):
+    _worker_state["incomes"] = shared_incomes.attach()
+    _worker_state["weights"] = shared_weights.attach()
+    _worker_state["schedule initial"] = schedule_initial
+    _worker_state["costing"] = costing
+    _worker_state["max cells"] = max_cells
+
+
+def weighted_revenue_change(gross_incomes, weights, schedule_initial, schedules, costing=library.CostingOptions(), max_cells=MAX_CELLS_PER_PASS):
+    # static and dynamic revenue change (£bn) for each schedule, with each taxpayer counting for its weight.
+    # Evaluates at most max_cells (scenario x taxpayer) cells at once
+    stacked_schedule = stack_schedules(schedules)
+    static_change = np.zeros(len(schedules))
+    dynamic_change = np.zeros(len(schedules))
+    chunk_size = max(1, max_cells // len(schedules))
+    for start in range(0, len(gross_incomes), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        results = library.calculate_effect_of_change(gross_incomes[chunk], schedule_initial, stacked_schedule, costing)
+        static_change += results["static tax change"] @ weights[chunk] / 1e9
+        dynamic_change += results["dynamic tax change"] @ weights[chunk] / 1e9
+    return static_change, dynamic_change
+
+
+def _run_task(schedules):
+    return weighted_revenue_change(_worker_state["incomes"], _worker_state["weights"], _worker_state["schedule initial"], schedules,
+                                   _worker_state["costing"], _worker_state["max cells"])
+
+
+def parallel_sweep_revenue(sweep, schedule_initial, gross_incomes, weights, processes=None, scenarios_per_task=None, costing=None):
+    # same results as UK_tax_sweep.sweep_revenue (when given the percentile incomes, each weighted at 1% of
+    # POPULATION_OF_TAXPAYERS), but spread over a pool of processes. By default costs with UK_tax_change_calculator's settings
+    if costing is None:
+        costing = calculator.costing_options()
+    processes = processes or os.cpu_count()
+    # every worker may be evaluating a chunk at once, so they share MEMORY_LIMIT
+    max_cells = min(MAX_CELLS_PER_PASS, max(1, int(MEMORY_LIMIT // (BYTES_PER_CELL * processes))))
+    if scenarios_per_task is None:
+        # a few tasks per process, so a slow task doesn't leave the others idle at the end
+        scenarios_per_task = max(1, -(-len(sweep) // (4 * processes)))
+
+    shared_incomes = SharedArray(np.asarray(gross_incomes, dtype=float))
+    shared_weights = SharedArray(np.asarray(weights, dtype=float))
+    try:
+        with ProcessPoolExecutor(max_workers=processes, initializer=_start_worker,
+                                 initargs=(shared_incomes, shared_weights, schedule_initial, costing, max_cells)) as executor:
+            tasks = [sweep.schedules[start:start + scenarios_per_task] for start in range(0, len(sweep), scenarios_per_task)]
+            results = list(executor.map(_run_task, tasks))
+    finally:
+        shared_incomes.release()
+        shared_weights.release()
+
+    return {"static": np.concatenate([static for static, _ in results]),
+            "dynamic": np.concatenate([dynamic for _, dynamic in results])}
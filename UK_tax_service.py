@@ -0,0 +1,447 @@
+import argparse
+import asyncio
+import json
+import time
+from dataclasses import fields
+from http import HTTPStatus
+
+import numpy as np
+
+from UK_tax_cache import ResultCache
+from UK_tax_engine import compile_schedule
+from UK_tax_library import DATASET_FILENAME, TaxOptions, calculate_breakdown, load_datasets
+from UK_tax_lookup import LOOKUP_COLUMNS, LOOKUP_DATASETS, LOOKUP_MAX_INCOME, load_or_build_lookup_tables
+from UK_tax_metrics import SIZE_BUCKETS, MetricsRegistry
+
+"""
+Local HTTP service for gross -> net, marginal rate and breakdown queries, so internal tools don't pay the Python,
+numpy and dataset start-up cost on every query.
+
+Every dataset in UK_marginal_tax_datasets.json is compiled once at start-up, and single-income results are kept
+in an LRU cache. Endpoints (all JSON):
+
+    GET  /datasets            names of the datasets
+    POST /calculate           {"dataset": "rUK 2024-25", "gross income": 50000, "options": {"do_child_benefit": true, "children": 2}}
+    POST /calculate/batch     {"dataset": "rUK 2024-25", "gross incomes": [10000, 20000, ...], "options": {...}}
+    POST /lookup              as /calculate, but returns only total tax/NI, net income and marginal rate - from
+                              the memory-mapped UK_tax_lookup tables if the service was started with --lookup-tables
+                              and one covers the query (a whole £ up to the table's maximum), otherwise calculated
+    GET  /health
+    GET  /stats               cache and micro-batching statistics
+    GET  /metrics             the same and more (request counts, latency by endpoint and dataset, schedule compile
+                              times, batch sizes) in the Prometheus text format
+
+"options" are the fields of UK_tax_library.TaxOptions, and can be left out. Each result has the elements of the
+tax (as UK_marginal_tax_rates' breakdown), net income and the exact marginal rate on the next £ earned; a batch
+returns each as a list, in the same order as the gross incomes.
+
+Single queries that miss the cache are micro-batched: those for the same dataset and options that arrive within
+BATCH_WINDOW_MS of each other are calculated in one array call, and the results handed back to each client.
+
+Run with: python UK_tax_service.py [--host 127.0.0.1] [--port 8642] [--batch-window-ms 1] [--max-batch-size 1024]
+                                  [--lookup-tables] [--lookup-max-income 500000]
+"""
+
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8642
+
+# single-income results to keep
+RESULT_CACHE_SIZE = 100000
+
+# largest request body accepted (a 100k-income batch is around 1MB)
+MAX_REQUEST_BYTES = 64 * 1024 * 1024
+
+# how long a single query waits for others to calculate with. 0 calculates each query on its own
+BATCH_WINDOW_MS = 1.0
+
+# a micro-batch is calculated as soon as it reaches this size, without waiting for the rest of the window
+MAX_BATCH_SIZE = 1024
+
+# batches bigger than this are calculated in a worker thread, so that single queries aren't held up behind them
+THREAD_BATCH_SIZE = 2000
+
+OPTION_NAMES = {option.name for option in fields(TaxOptions)}
+
+# limits on what a request can ask for, so every result is a finite number
+MAX_GROSS_INCOME = 1e12
+MAX_CHILDREN = 20
+MAX_STUDENT_LOAN_THRESHOLD = 1e7
+
+
+class RequestError(Exception):
+    # a problem with the client's request; reported back to it with this status
+    def __init__(self, message, status=HTTPStatus.BAD_REQUEST):
+        super().__init__(message)
+        self.status = status
+
+
+class TaxCalculator:
+    # the service's warm state: every dataset compiled, and a cache of single-income results
+
+    def __init__(self, tax_data, cache_size=RESULT_CACHE_SIZE, lookup_tables=None):
+        self.lookup_tables = lookup_tables or {}
+        self.schedules = {}
+        self.compile_seconds = {}
+        for dataset, relevant_data in tax_data.items():
+            start_time = time.perf_counter()
+            self.schedules[dataset] = compile_schedule(relevant_data)
+            self.compile_seconds[dataset] = time.perf_counter() - start_time
+        self.result_cache = ResultCache(maxsize=cache_size)
+
+    def schedule(self, dataset):
+        try:
+            return self.schedules[dataset]
+        except (KeyError, TypeError):
+            raise RequestError(f"Unknown dataset '{dataset}'", HTTPStatus.NOT_FOUND) from None
+
+    def calculate(self, dataset, gross_incomes, options):
+        # each element of the calculation as an array, for any number of gross incomes at once
+        return calculate_breakdown(self.schedule(dataset), gross_incomes, options)
+
+    def calculate_single(self, dataset, gross_income, options):
+        key = (dataset, options, gross_income)
+        return self.result_cache.get_or_compute(key, lambda: self.calculate_rows(dataset, np.array([gross_income]), options)[0])
+
+    def calculate_rows(self, dataset, gross_incomes, options):
+        # one dict of results per gross income
+        columns = self.calculate_batch(dataset, gross_incomes, options)
+        return [dict(zip(columns, row)) for row in zip(*columns.values())]
+
+    def calculate_batch(self, dataset, gross_incomes, options):
+        return {name: np.broadcast_to(values, gross_incomes.shape).tolist() for name, values in self.calculate(dataset, gross_incomes, options).items()}
+
+
+class MicroBatcher:
+    # collects single-income queries for the same (dataset, options) that arrive within window_ms of the first,
+    # and calculates them with one call of the array engine. Runs on the event loop, so needs no locking.
+    # Only waits for the window if the last batch had company; otherwise a batch is just the queries already read
+    # in the same pass of the event loop, so a lone client doesn't wait window_ms for nothing
+
+    def __init__(self, calculator, window_ms=BATCH_WINDOW_MS, max_batch_size=MAX_BATCH_SIZE, batch_size_histogram=None):
+        self.calculator = calculator
+        self.batch_size_histogram = batch_size_histogram
+        self.window_ms = window_ms
+        self.max_batch_size = max_batch_size
+        self._pending = {}
+        self._last_batch_size = 0
+
+        self.batches = 0
+        self.batched_queries = 0
+        self.largest_batch = 0
+
+    async def calculate(self, dataset, gross_income, options):
+        key = (dataset, options)
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = []
+            if self._last_batch_size > 1:
+                asyncio.get_running_loop().call_later(self.window_ms / 1000, self._flush, key, batch)
+            else:
+                asyncio.get_running_loop().call_soon(self._flush, key, batch)
+
+        future = asyncio.get_running_loop().create_future()
+        batch.append((gross_income, future))
+        if len(batch) >= self.max_batch_size:
+            self._flush(key, batch)
+        return await future
+
+    def _flush(self, key, batch):
+        # the timer for a batch that's already been calculated (because it filled up) does nothing
+        if self._pending.get(key) is not batch:
+            return
+        del self._pending[key]
+
+        self.batches += 1
+        self.batched_queries += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        self._last_batch_size = len(batch)
+        if self.batch_size_histogram is not None:
+            self.batch_size_histogram.observe(len(batch))
+
+        dataset, options = key
+        try:
+            rows = self.calculator.calculate_rows(dataset, np.array([gross_income for gross_income, _ in batch]), options)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (gross_income, future), row in zip(batch, rows):
+            self.calculator.result_cache.put((dataset, options, gross_income), row)
+            if not future.done():   # the client may have gone away
+                future.set_result(row)
+
+    def stats(self):
+        return {"batches": self.batches,
+                "batched queries": self.batched_queries,
+                "mean batch size": self.batched_queries / self.batches if self.batches else 0.0,
+                "largest batch": self.largest_batch,
+                "window ms": self.window_ms,
+                "max batch size": self.max_batch_size}
+
+
+def parse_body(body):
+    if not body:
+        return {}
+    try:
+        request = json.loads(body)
+    except ValueError:
+        raise RequestError("Request body isn't valid JSON") from None
+    if not isinstance(request, dict):
+        raise RequestError("Request body must be a JSON object")
+    return request
+
+
+def parse_options(request):
+    options = request.get("options", {})
+    if not isinstance(options, dict):
+        raise RequestError("'options' must be an object")
+    unknown = set(options) - OPTION_NAMES
+    if unknown:
+        raise RequestError(f"Unknown options {sorted(unknown)}; valid options are {sorted(OPTION_NAMES)}")
+    for name, value in options.items():
+        if name == "children":
+            if not isinstance(value, int) or not is_number_in_range(value, 0, MAX_CHILDREN):
+                raise RequestError(f"'children' must be a whole number from 0 to {MAX_CHILDREN}")
+        elif name == "student_loan_threshold":
+            if not is_number_in_range(value, 0, MAX_STUDENT_LOAN_THRESHOLD):
+                raise RequestError(f"'student_loan_threshold' must be a number from 0 to {MAX_STUDENT_LOAN_THRESHOLD:,.0f}")
+        elif name == "student_loan_rate":
+            if not is_number_in_range(value, 0, 1):
+                raise RequestError("'student_loan_rate' must be a number from 0 to 1")
+        elif not isinstance(value, bool):
+            raise RequestError(f"'{name}' must be true or false")
+    return TaxOptions(**options)
+
+
+def parse_dataset(request):
+    # checked before it's used as a cache or batcher key; whether it exists is checked when it's calculated
+    dataset = request.get("dataset")
+    if not isinstance(dataset, str):
+        raise RequestError("'dataset' must be a string")
+    return dataset
+
+
+def is_number_in_range(value, low, high):
+    # False for bools, NaN, infinities and anything else that isn't a number in [low, high]
+    return not isinstance(value, bool) and isinstance(value, (int, float)) and low <= value <= high
+
+
+def parse_gross_income(value):
+    if not is_number_in_range(value, 0, MAX_GROSS_INCOME):
+        raise RequestError(f"'gross income' must be a number from 0 to {MAX_GROSS_INCOME:,.0f}")
+    return float(value)
+
+
+def parse_gross_incomes(values):
+    if not isinstance(values, list):
+        raise RequestError("'gross incomes' must be a list of numbers")
+    try:
+        gross_incomes = np.array(values, dtype=float)
+    except (TypeError, ValueError):
+        raise RequestError("'gross incomes' must be a list of numbers") from None
+    if gross_incomes.ndim != 1 or not np.all((0 <= gross_incomes) & (gross_incomes <= MAX_GROSS_INCOME)):
+        raise RequestError(f"'gross incomes' must be a list of numbers from 0 to {MAX_GROSS_INCOME:,.0f}")
+    return gross_incomes
+
+
+class TaxService:
+    # minimal HTTP/1.1 server (keep-alive, JSON bodies with a Content-Length) on asyncio streams
+
+    def __init__(self, calculator, batch_window_ms=BATCH_WINDOW_MS, max_batch_size=MAX_BATCH_SIZE):
+        self.calculator = calculator
+
+        self.metrics = MetricsRegistry()
+        self.request_count = self.metrics.counter("tax_service_requests_total", "Requests handled", ("endpoint", "status"))
+        self.request_duration = self.metrics.histogram("tax_service_request_duration_seconds", "Time from reading a request to having its response", ("endpoint", "dataset"))
+        self.lookup_count = self.metrics.counter("tax_service_lookups_total", "/lookup queries, by whether they were answered from a lookup table or calculated", ("source",))
+        self.batch_request_size = self.metrics.histogram("tax_service_batch_request_incomes", "Gross incomes in each /calculate/batch request", buckets=SIZE_BUCKETS)
+        micro_batch_size = self.metrics.histogram("tax_service_micro_batch_size", "Single queries calculated together by the micro-batcher", buckets=SIZE_BUCKETS)
+        self.metrics.callback("tax_service_result_cache_hits_total", "Single queries answered from the result cache", lambda: calculator.result_cache.hits, "counter")
+        self.metrics.callback("tax_service_result_cache_misses_total", "Single queries not in the result cache", lambda: calculator.result_cache.misses, "counter")
+        self.metrics.callback("tax_service_result_cache_hit_ratio", "Proportion of single queries answered from the result cache", calculator.result_cache.hit_rate)
+        self.metrics.callback("tax_service_result_cache_entries", "Results in the result cache", lambda: len(calculator.result_cache))
+        compile_time = self.metrics.gauge("tax_service_schedule_compile_seconds", "Time taken to compile each dataset at start-up", ("dataset",))
+        for dataset, seconds in calculator.compile_seconds.items():
+            compile_time.set(dataset, value=seconds)
+
+        self.batcher = MicroBatcher(calculator, batch_window_ms, max_batch_size, micro_batch_size) if batch_window_ms > 0 else None
+        self.routes = {
+            ("GET", "/health"): self.health,
+            ("GET", "/stats"): self.stats,
+            ("GET", "/metrics"): self.render_metrics,
+            ("GET", "/datasets"): self.datasets,
+            ("POST", "/calculate"): self.calculate,
+            ("POST", "/calculate/batch"): self.calculate_batch,
+            ("POST", "/lookup"): self.lookup,
+        }
+
+    async def health(self, request):
+        return {"status": "ok"}
+
+    async def stats(self, request):
+        return {"result cache": {"hits": self.calculator.result_cache.hits,
+                                 "misses": self.calculator.result_cache.misses,
+                                 "entries": len(self.calculator.result_cache)},
+                "micro-batching": self.batcher.stats() if self.batcher is not None else None}
+
+    async def render_metrics(self, request):
+        return self.metrics.render()
+
+    async def datasets(self, request):
+        return {"datasets": list(self.calculator.schedules)}
+
+    async def calculate(self, request):
+        options = parse_options(request)
+        dataset = parse_dataset(request)
+        gross_income = parse_gross_income(request.get("gross income"))
+        if self.batcher is None:
+            return self.calculator.calculate_single(dataset, gross_income, options)
+
+        result = self.calculator.result_cache.get((dataset, options, gross_income))
+        if result is None:
+            result = await self.batcher.calculate(dataset, gross_income, options)
+        return result
+
+    async def lookup(self, request):
+        options = parse_options(request)
+        dataset = parse_dataset(request)
+        gross_income = parse_gross_income(request.get("gross income"))
+
+        table = self.calculator.lookup_tables.get((dataset, options))
+        if table is not None and table.covers(gross_income):
+            self.lookup_count.inc("table")
+            return {"gross income": gross_income, **table.lookup(gross_income)}
+
+        self.lookup_count.inc("engine")
+        result = await self.calculate(request)
+        return {column: result[column] for column in ("gross income",) + LOOKUP_COLUMNS}
+
+    async def calculate_batch(self, request):
+        options = parse_options(request)
+        dataset = parse_dataset(request)
+        gross_incomes = parse_gross_incomes(request.get("gross incomes"))
+        self.batch_request_size.observe(len(gross_incomes))
+        if len(gross_incomes) > THREAD_BATCH_SIZE:
+            return await asyncio.to_thread(self.calculator.calculate_batch, dataset, gross_incomes, options)
+        return self.calculator.calculate_batch(dataset, gross_incomes, options)
+
+    async def handle_request(self, method, path, body):
+        # status and response for one request, recording its metrics
+        start_time = time.perf_counter()
+        request = {}
+        try:
+            handler = self.route(method, path)
+            request = parse_body(body)
+            status, response = HTTPStatus.OK, await handler(request)
+        except RequestError as e:
+            status, response = e.status, {"error": str(e)}
+        except Exception as e:
+            # a bug rather than a bad request; the service carries on
+            status, response = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": f"{type(e).__name__}: {e}"}
+
+        # labelled only with known endpoints and datasets, so a client can't create unlimited series
+        endpoint = path if any(route_path == path for _, route_path in self.routes) else "other"
+        dataset = request.get("dataset")
+        dataset = dataset if isinstance(dataset, str) and dataset in self.calculator.schedules else ""
+        self.request_count.inc(endpoint, status.value)
+        self.request_duration.observe(time.perf_counter() - start_time, endpoint, dataset)
+        return status, response
+
+    def route(self, method, path):
+        handler = self.routes.get((method, path))
+        if handler is None:
+            if any(route_path == path for _, route_path in self.routes):
+                raise RequestError(f"{method} not allowed for {path}", HTTPStatus.METHOD_NOT_ALLOWED)
+            raise RequestError(f"No such endpoint {path}", HTTPStatus.NOT_FOUND)
+        return handler
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    await self.respond(writer, HTTPStatus.BAD_REQUEST, {"error": "Malformed request line"}, keep_alive=False)
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                try:
+                    length = int(headers.get("content-length", 0) or 0)
+                    if length < 0:
+                        raise ValueError(length)
+                except ValueError:
+                    await self.respond(writer, HTTPStatus.BAD_REQUEST, {"error": "Malformed Content-Length"}, keep_alive=False)
+                    break
+                if length > MAX_REQUEST_BYTES:
+                    await self.respond(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {"error": f"Request body over {MAX_REQUEST_BYTES:,} bytes"}, keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                status, response = await self.handle_request(method, target.split("?", 1)[0], body)
+                await self.respond(writer, status, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, response, keep_alive):
+        if isinstance(response, str):
+            body, content_type = response.encode("utf-8"), "text/plain; version=0.0.4"
+        else:
+            try:
+                body = json.dumps(response, allow_nan=False).encode("utf-8")
+            except ValueError:
+                # NaN or infinity isn't valid JSON; shouldn't happen with the limits on requests, but never send it
+                status = HTTPStatus.INTERNAL_SERVER_ERROR
+                body = json.dumps({"error": "Result is not a finite number"}).encode("utf-8")
+            content_type = "application/json"
+        writer.write(f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                     f"Content-Type: {content_type}\r\n"
+                     f"Content-Length: {len(body)}\r\n"
+                     f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + body)
+        await writer.drain()
+
+    async def serve(self, host=SERVICE_HOST, port=SERVICE_PORT):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Local HTTP service for UK tax calculations")
+    parser.add_argument("--host", default=SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    parser.add_argument("--datasets", default=DATASET_FILENAME, help="json file of datasets")
+    parser.add_argument("--batch-window-ms", type=float, default=BATCH_WINDOW_MS, help="micro-batching window; 0 to turn off")
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument("--lookup-tables", action="store_true", help=f"memory-map lookup tables for {', '.join(LOOKUP_DATASETS)} (building them if needed)")
+    parser.add_argument("--lookup-max-income", type=int, default=LOOKUP_MAX_INCOME)
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    tax_data = load_datasets(args.datasets)
+    lookup_tables = load_or_build_lookup_tables(tax_data, max_income=args.lookup_max_income) if args.lookup_tables else None
+    calculator = TaxCalculator(tax_data, lookup_tables=lookup_tables)
+    print(f"Compiled {len(calculator.schedules)} datasets{f' and mapped {len(lookup_tables)} lookup tables' if lookup_tables else ''} "
+          f"in {1000 * (time.perf_counter() - start_time):.1f}ms; serving on http://{args.host}:{args.port}")
+
+    try:
+        asyncio.run(TaxService(calculator, args.batch_window_ms, args.max_batch_size).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
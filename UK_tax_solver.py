@@ -0,0 +1,106 @@
+import numpy as np
+
+import UK_tax_change_calculator as calculator
+import UK_tax_library as library
+from UK_tax_engine import compile_schedule, stack_schedules
+from UK_tax_sweep import with_parameters
+
+"""
+Solving for a parameter value that gives a target revenue change, e.g. "what basic rate threshold makes the
+Reform UK manifesto revenue-neutral?" or "what additional rate raises £Xbn?".
+
+This is a bracketing search: we're given a range of values for the parameter in which the revenue change
+crosses the target, and narrow it down. Each iteration tries several values in the range at once (one stacked,
+vectorised evaluation) plus a linear interpolation towards the target, and keeps the part of the range where
+the target is crossed. Revenue is piecewise linear in most parameters, so the interpolation usually lands
+within £1m in a handful of iterations; the bracketing guarantees we get there regardless.
+"""
+
+# £bn, so £1m
+REVENUE_TOLERANCE = 0.001
+
+# values of the parameter tried per iteration
+POINTS_PER_ITERATION = 8
+
+MAX_ITERATIONS = 50
+
+
+class RevenueSolver:
+    # revenue change of a dataset with one parameter varied, compared to a fixed starting schedule. The starting
+    # position (tax and marginal rate at each income) and every compiled variant are cached, so repeated
+    # evaluations only cost the policy-change side of the calculation
+
+    def __init__(self, relevant_data, parameter, schedule_initial, gross_incomes=None, dynamic=False, costing=None):
+        # by default costs with UK_tax_change_calculator's settings
+        if costing is None:
+            costing = calculator.costing_options()
+        if gross_incomes is None:
+            _, gross_incomes = calculator.load_percentile_incomes()
+        self.relevant_data = relevant_data
+        self.parameter = parameter
+        self.schedule_initial = schedule_initial
+        self.gross_incomes = np.asarray(gross_incomes, dtype=float)
+        self.dynamic = dynamic
+        self.costing = costing
+        self.baseline = library.calculate_baseline(self.gross_incomes, schedule_initial, costing)
+        self.schedules = {}
+        self.evaluations = 0
+
+    def schedule(self, value):
+        if value not in self.schedules:
+            self.schedules[value] = compile_schedule(with_parameters(self.relevant_data, {self.parameter: value}))
+        return self.schedules[value]
+
+    def revenue_change(self, values):
+        # £bn for each value, in one stacked evaluation
+        values = [float(value) for value in values]
+        stacked_schedule = stack_schedules([self.schedule(value) for value in values])
+        results = library.calculate_effect_of_change(self.gross_incomes, self.schedule_initial, stacked_schedule, self.costing, self.baseline)
+        self.evaluations += 1
+        return library.total_revenue_change(results["dynamic tax change" if self.dynamic else "static tax change"], self.costing)
+
+    def solve(self, low, high, target=0.0, tolerance=REVENUE_TOLERANCE):
+        low_error, high_error = self.revenue_change([low, high]) - target
+        if np.sign(low_error) == np.sign(high_error) and low_error != 0 and high_error != 0:
+            raise ValueError(f"Revenue change doesn't cross £{target:,.3f}bn between {low:,} and {high:,} "
+                             f"(£{low_error + target:,.3f}bn to £{high_error + target:,.3f}bn)")
+
+        for _ in range(MAX_ITERATIONS):
+            for value, error in ((low, low_error), (high, high_error)):
+                if abs(error) <= tolerance:
+                    return {"value": value, "revenue change": error + target, "evaluations": self.evaluations}
+
+            # evenly spaced points across the range, plus where a straight line between the ends hits the target
+            interpolated = low - low_error * (high - low) / (high_error - low_error)
+            values = np.unique(np.append(np.linspace(low, high, POINTS_PER_ITERATION + 1)[1:-1], interpolated))
+            errors = self.revenue_change(values) - target
+
+            best = np.argmin(np.abs(errors))
+            if abs(errors[best]) <= tolerance:
+                return {"value": float(values[best]), "revenue change": float(errors[best] + target), "evaluations": self.evaluations}
+
+            # keep the narrowest part of the range in which the target is still crossed
+            all_values = np.concatenate(([low], values, [high]))
+            all_errors = np.concatenate(([low_error], errors, [high_error]))
+            crossing = np.flatnonzero(np.sign(all_errors[:-1]) != np.sign(all_errors[1:]))[0]
+            low, high = all_values[crossing], all_values[crossing + 1]
+            low_error, high_error = all_errors[crossing], all_errors[crossing + 1]
+
+        raise RuntimeError(f"Didn't get within £{tolerance:,.3f}bn of the target in {MAX_ITERATIONS} iterations")
+
+
+def solve_for_revenue(relevant_data, parameter, low, high, schedule_initial, target=0.0, dynamic=False, gross_incomes=None, costing=None):
+    return RevenueSolver(relevant_data, parameter, schedule_initial, gross_incomes, dynamic, costing).solve(low, high, target)
+
+
+if __name__ == '__main__':
+
+    tax_data = calculator.load_data_from_json()
+    schedule_initial = compile_schedule(tax_data[calculator.DATASET_INITIAL])
+
+    # examples: the basic rate band, and the personal allowance, that would make the policy change revenue-neutral
+    for parameter, low, high in [("income tax[0].threshold", 1000, 60000), ("statutory personal allowance", 0, 20000)]:
+        for dynamic in (False, True):
+            solution = solve_for_revenue(tax_data[calculator.DATASET_POLICY_CHANGE], parameter, low, high, schedule_initial, dynamic=dynamic)
+            print(f"'{calculator.DATASET_POLICY_CHANGE}' is revenue-neutral ({'dynamic' if dynamic else 'static'}) with {parameter} "
+                  f"{solution['value']:,.0f} (£{solution['revenue change']:,.4f}bn, {solution['evaluations']} evaluations)")
@@ -0,0 +1,125 @@
+import copy
+import itertools
+import re
+from dataclasses import dataclass
+
+import numpy as np
+
+import UK_tax_change_calculator as calculator
+import UK_tax_library as library
+from UK_tax_engine import MAX_CELLS_PER_PASS, calculate_marginal_rates, calculate_tax_components, combine_total_tax, compile_schedule, stack_schedules
+
+"""
+Parameter sweeps: many variants of one dataset evaluated together.
+
+A parameter is given by its path in the dataset's json, e.g. "income tax[1].threshold", "NI[1].rate",
+"statutory personal allowance" or "child benefit.1st". Each parameter is given a range of values, and every
+combination of values is a scenario. The scenarios are compiled and stacked, and then evaluated over all
+incomes in one (scenario x income) pass, rather than by editing UK_marginal_tax_datasets.json and rerunning.
+"""
+
+
+def parse_parameter_path(path):
+    # "income tax[1].threshold" -> ["income tax", 1, "threshold"]
+    keys = []
+    for part in path.split("."):
+        match = re.fullmatch(r"([^\[\]]+)((?:\[\d+\])*)", part.strip())
+        if match is None:
+            raise ValueError(f"Can't understand parameter path '{path}'")
+        keys.append(match.group(1))
+        keys += [int(index) for index in re.findall(r"\[(\d+)\]", match.group(2))]
+    return keys
+
+
+def with_parameters(relevant_data, parameter_values):
+    # a copy of the dataset with each parameter path set to its value; the original is left untouched
+    modified_data = copy.deepcopy(relevant_data)
+    for path, value in parameter_values.items():
+        keys = parse_parameter_path(path)
+        container = modified_data
+        try:
+            for key in keys[:-1]:
+                container = container[key]
+            if isinstance(container, dict) and keys[-1] not in container:
+                raise KeyError(keys[-1])
+            container[keys[-1]] = value
+        except (KeyError, IndexError, TypeError):
+            raise ValueError(f"Parameter path '{path}' isn't in the dataset") from None
+    return modified_data
+
+
+@dataclass(frozen=True)
+class Sweep:
+    # parameter_values[i, j] is the value of parameters[j] in scenario i
+    parameters: tuple
+    parameter_values: np.ndarray
+    schedules: tuple
+
+    def __len__(self):
+        return len(self.schedules)
+
+    def scenario(self, i):
+        return dict(zip(self.parameters, self.parameter_values[i]))
+
+
+def build_sweep(relevant_data, parameter_ranges):
+    # parameter_ranges maps each parameter path to the values to try; every combination is a scenario
+    parameters = tuple(parameter_ranges)
+    combinations = list(itertools.product(*(parameter_ranges[parameter] for parameter in parameters)))
+    schedules = tuple(compile_schedule(with_parameters(relevant_data, dict(zip(parameters, values)))) for values in combinations)
+    return Sweep(parameters, np.array(combinations, dtype=float).reshape(len(combinations), len(parameters)), schedules)
+
+
+def _scenario_chunks(sweep, number_of_incomes):
+    # (rows of the results, stacked schedule for those scenarios)
+    chunk_size = max(1, MAX_CELLS_PER_PASS // max(1, number_of_incomes))
+    for start in range(0, len(sweep), chunk_size):
+        rows = slice(start, min(start + chunk_size, len(sweep)))
+        yield rows, stack_schedules(sweep.schedules[rows])
+
+
+def sweep_tax(sweep, gross_incomes, **options):
+    # total tax and marginal rate for every (scenario, income), each shaped (scenarios, incomes)
+    gross_incomes = np.asarray(gross_incomes, dtype=float)
+    total_tax = np.empty((len(sweep), len(gross_incomes)))
+    marginal_rate = np.empty((len(sweep), len(gross_incomes)))
+    for rows, stacked_schedule in _scenario_chunks(sweep, len(gross_incomes)):
+        total_tax[rows] = combine_total_tax(calculate_tax_components(gross_incomes[np.newaxis, :], stacked_schedule, **options))
+        marginal_rate[rows] = calculate_marginal_rates(gross_incomes[np.newaxis, :], stacked_schedule, **options)
+    return {"gross income": gross_incomes, "total tax/NI": total_tax, "net income": gross_incomes - total_tax, "marginal rate": marginal_rate}
+
+
+def sweep_revenue(sweep, schedule_initial, gross_incomes=None, costing=None):
+    # static and dynamic revenue change (£bn) of each scenario compared to schedule_initial, using the
+    # UK_tax_change_calculator methodology over the income percentiles. Each result is shaped (scenarios,).
+    # By default costs with UK_tax_change_calculator's settings
+    if costing is None:
+        costing = calculator.costing_options()
+    if gross_incomes is None:
+        _, gross_incomes = calculator.load_percentile_incomes()
+    gross_incomes = np.asarray(gross_incomes, dtype=float)
+
+    static_change = np.empty(len(sweep))
+    dynamic_change = np.empty(len(sweep))
+    for rows, stacked_schedule in _scenario_chunks(sweep, len(gross_incomes)):
+        results = library.calculate_effect_of_change(gross_incomes, schedule_initial, stacked_schedule, costing)
+        static_change[rows] = library.total_revenue_change(results["static tax change"], costing)
+        dynamic_change[rows] = library.total_revenue_change(results["dynamic tax change"], costing)
+    return {"static": static_change, "dynamic": dynamic_change}
+
+
+if __name__ == '__main__':
+
+    tax_data = calculator.load_data_from_json()
+
+    # example: where the basic rate band ends under the policy change, and the higher rate
+    sweep = build_sweep(tax_data[calculator.DATASET_POLICY_CHANGE], {
+        "income tax[0].threshold": np.arange(37700, 62701, 2500),
+        "income tax[1].rate": [0.38, 0.40, 0.42],
+    })
+    revenue = sweep_revenue(sweep, compile_schedule(tax_data[calculator.DATASET_INITIAL]))
+
+    print(f"Variants of '{calculator.DATASET_POLICY_CHANGE}' compared to '{calculator.DATASET_INITIAL}':")
+    for i in range(len(sweep)):
+        scenario = ", ".join(f"{parameter} = {value:,.2f}" for parameter, value in sweep.scenario(i).items())
+        print(f"{scenario}: static £{revenue['static'][i]:,.1f}bn, dynamic £{revenue['dynamic'][i]:,.1f}bn")